@@ -56,6 +56,7 @@ $app->group('/v1', function (Slim\Routing\RouteCollectorProxy $group) {
 
     // 1. Sensor Data
     $group->post('/sensors', 'App\Services\Greenhouse\SensorData');
+    $group->post('/sensors/batch', 'App\Services\Greenhouse\SensorBatch');
     $group->get('/latest', 'App\Services\Greenhouse\GetLatestData:getAll');
     $group->get('/latest/{value_key}', 'App\Services\Greenhouse\GetLatestData:getByKey');
     $group->get('/history/{value_key}', 'App\Services\Greenhouse\GetHistoryData');
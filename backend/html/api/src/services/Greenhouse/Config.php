@@ -27,8 +27,15 @@ class Config {
                 $stmt->execute([':value' => json_encode($config)]);
             }
 
-            $response->getBody()->write(json_encode($config));
-            return $response->withHeader('Content-Type', 'application/json');
+            // Conditional GET: controllers poll this, so answer 304 when nothing changed
+            $body = json_encode($config);
+            $etag = '"' . md5($body) . '"';
+            if ($request->getHeaderLine('If-None-Match') === $etag) {
+                return $response->withStatus(304)->withHeader('ETag', $etag);
+            }
+
+            $response->getBody()->write($body);
+            return $response->withHeader('Content-Type', 'application/json')->withHeader('ETag', $etag);
 
         } catch (\Exception $e) {
             $response->getBody()->write(json_encode(['error' => $e->getMessage()]));
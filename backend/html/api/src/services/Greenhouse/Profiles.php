@@ -84,8 +84,15 @@ class Profiles {
                 'setpoints' => $setpoints
             ];
 
-            $response->getBody()->write(json_encode($result));
-            return $response->withHeader('Content-Type', 'application/json');
+            // Conditional GET: controllers poll this, so answer 304 when nothing changed
+            $body = json_encode($result);
+            $etag = '"' . md5($body) . '"';
+            if ($request->getHeaderLine('If-None-Match') === $etag) {
+                return $response->withStatus(304)->withHeader('ETag', $etag);
+            }
+
+            $response->getBody()->write($body);
+            return $response->withHeader('Content-Type', 'application/json')->withHeader('ETag', $etag);
 
         } catch (\Exception $e) {
             $response->getBody()->write(json_encode(['error' => $e->getMessage()]));
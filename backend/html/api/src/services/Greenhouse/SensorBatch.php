@@ -0,0 +1,57 @@
+<?php
+
+namespace App\Services\Greenhouse;
+
+use Psr\Http\Message\ResponseInterface as Response;
+use Psr\Http\Message\ServerRequestInterface as Request;
+use App\Config\Database;
+use PDO;
+
+class SensorBatch {
+    public function __invoke(Request $request, Response $response) {
+        $data = $request->getParsedBody();
+
+        if (!isset($data['readings']) || !is_array($data['readings'])) {
+            $response->getBody()->write(json_encode(['error' => 'Invalid payload']));
+            return $response->withStatus(400)->withHeader('Content-Type', 'application/json');
+        }
+
+        $db = new Database();
+        $conn = $db->connect();
+
+        try {
+            // One transaction for the whole batch
+            $conn->beginTransaction();
+            $stmt = $conn->prepare("INSERT INTO sensor_readings (timestamp, topic, value_key, value) VALUES (:timestamp, :topic, :key, :value)");
+
+            $inserted = 0;
+            foreach ($data['readings'] as $reading) {
+                if (!isset($reading['topic']) || !isset($reading['data']) || !is_array($reading['data'])) continue;
+
+                $topic = $reading['topic'];
+                $timestamp = $reading['timestamp'] ?? date('Y-m-d H:i:s');
+
+                foreach ($reading['data'] as $key => $value) {
+                    if ($key === 'rssi') continue;
+                    if (is_numeric($value)) {
+                        $stmt->execute([
+                            ':timestamp' => $timestamp,
+                            ':topic' => $topic,
+                            ':key' => $key,
+                            ':value' => $value
+                        ]);
+                        $inserted++;
+                    }
+                }
+            }
+            $conn->commit();
+            $response->getBody()->write(json_encode(['status' => 'success', 'inserted' => $inserted]));
+            return $response->withHeader('Content-Type', 'application/json');
+
+        } catch (\Exception $e) {
+            $conn->rollBack();
+            $response->getBody()->write(json_encode(['error' => $e->getMessage()]));
+            return $response->withStatus(500)->withHeader('Content-Type', 'application/json');
+        }
+    }
+}
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Exports sensor readings and fan logs of greenhouse_data.db as CSV, Parquet or Arrow IPC.
+
+    python3 export_data.py readings --hours 24 --keys temp,humidity
+    python3 export_data.py readings --start 2025-01-01 --end 2026-01-01 --format parquet
+    python3 export_data.py fan_logs --start 2025-06-01 --format arrow --out fan.arrow
+
+Safe to run next to mqtt_localSQL.py: rows are read in short one-hour windows (each its own
+statement, so WAL checkpoints are never held back for long) and written out batch by batch,
+so a year of data is exported with bounded memory. mqtt_localSQL.py serves the same export
+at /api/v1/export. Parquet and Arrow need pyarrow; CSV has no extra dependency.
+Convert a legacy sensor_readings table with migrate_storage.py first: it is not exported.
+"""
+import argparse
+import csv
+import io
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+try:
+    import pyarrow as pa  # Optional: Parquet and Arrow IPC output
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+DB_NAME = "greenhouse_data.db"
+EXPORT_KINDS = ("readings", "fan_logs")
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+EXPORT_BATCH_ROWS = 20000      # Rows per encoded batch (and Parquet row group)
+EXPORT_WINDOW_MS = 3600 * 1000  # Time span read per statement
+CSV_COLUMNS = {
+    "readings": ("timestamp", "topic", "key", "value"),
+    "fan_logs": ("timestamp", "duty_cycle", "status"),
+}
+
+
+# ==================== Reading ====================
+
+def month_of_ms(ts: int) -> str:
+    t = datetime.fromtimestamp(ts / 1000)
+    return f"{t.year}{t.month:02d}"
+
+def month_start_ms(month: str) -> int:
+    return int(datetime(int(month[:4]), int(month[4:]), 1).timestamp() * 1000)
+
+def next_month_start_ms(month: str) -> int:
+    year, mon = int(month[:4]), int(month[4:])
+    return int(datetime(year + mon // 12, mon % 12 + 1, 1).timestamp() * 1000)
+
+def list_partitions(conn: sqlite3.Connection, kind: str, start_ms: int, end_ms: int) -> list:
+    """(table, first_ms, end_ms) of the monthly partitions of kind overlapping [start_ms, end_ms), oldest first.
+    The legacy unpartitioned table, if any, comes first and covers the whole range."""
+    first_month, last_month = month_of_ms(start_ms), month_of_ms(end_ms - 1)
+    result = []
+    for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND (name = ? OR name GLOB ?) ORDER BY name",
+        (kind, f"{kind}_[0-9][0-9][0-9][0-9][0-9][0-9]")
+    ):
+        month = name[len(kind) + 1:]
+        if not month:
+            result.append((name, start_ms, end_ms))
+        elif first_month <= month <= last_month:
+            result.append((name, max(start_ms, month_start_ms(month)), min(end_ms, next_month_start_ms(month))))
+    return result
+
+def ms_to_local_iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000).isoformat()
+
+def iso_to_us(timestamp: str) -> int:
+    """Naive local ISO timestamp -> epoch microseconds, exact to the microsecond."""
+    t = datetime.fromisoformat(timestamp)
+    return int(t.replace(microsecond=0).timestamp()) * 1_000_000 + t.microsecond
+
+def us_to_iso(ts_us: int) -> str:
+    return datetime.fromtimestamp(ts_us // 1_000_000).replace(microsecond=ts_us % 1_000_000).isoformat(timespec="microseconds")
+
+def iter_export_batches(conn: sqlite3.Connection, kind: str, start_ms: int, end_ms: int, keys: list | None = None):
+    """
+    Yields lists of at most EXPORT_BATCH_ROWS rows in time order, timestamps as epoch microseconds:
+    readings (ts_us, topic, key, value) for the given value keys (all if None), fan_logs (ts_us, duty_cycle, status).
+    """
+    if kind == "readings":
+        sql = "SELECT id, topic, value_key FROM series"
+        if keys is not None:
+            sql += f" WHERE value_key IN ({','.join('?' * len(keys))})"
+        series = {row[0]: (row[1], row[2]) for row in conn.execute(sql, keys or ())}
+        if not series:
+            return
+        placeholders = ",".join("?" * len(series))
+
+    batch = []
+    for table, first_ms, last_ms in list_partitions(conn, kind, start_ms, end_ms):
+        for window_start in range(first_ms, last_ms, EXPORT_WINDOW_MS):
+            window_end = min(window_start + EXPORT_WINDOW_MS, last_ms)
+            if kind == "readings":
+                rows = conn.execute(
+                    f"""SELECT ts, series_id, value FROM {table}
+                        WHERE series_id IN ({placeholders}) AND ts >= ? AND ts < ? ORDER BY ts, series_id""",
+                    (*series, window_start, window_end)
+                ).fetchall()
+                batch.extend((ts * 1000, *series[series_id], value) for ts, series_id, value in rows)
+            else:
+                rows = conn.execute(
+                    f"""SELECT timestamp, duty_cycle, status FROM {table}
+                        WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp, id""",
+                    (ms_to_local_iso(window_start), ms_to_local_iso(window_end))
+                ).fetchall()
+                batch.extend((iso_to_us(timestamp), duty, status) for timestamp, duty, status in rows)
+            while len(batch) >= EXPORT_BATCH_ROWS:
+                yield batch[:EXPORT_BATCH_ROWS]
+                batch = batch[EXPORT_BATCH_ROWS:]
+    if batch:
+        yield batch
+
+
+# ==================== Encoding ====================
+
+class ChunkSink:
+    """Write-only file object collecting encoder output between drains; tell() stays absolute, as Parquet needs."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return False
+
+    def drain(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def arrow_schema(kind: str):
+    timestamp = ("timestamp", pa.timestamp("us", tz="UTC"))
+    if kind == "readings":
+        return pa.schema([timestamp, ("topic", pa.string()), ("key", pa.string()), ("value", pa.float64())])
+    return pa.schema([timestamp, ("duty_cycle", pa.int32()), ("status", pa.string())])
+
+def arrow_batch(schema, rows: list):
+    columns = list(zip(*rows))
+    return pa.record_batch([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+def check_export_format(fmt: str):
+    """Raises RuntimeError if fmt cannot be written here (Parquet and Arrow need pyarrow)."""
+    if fmt not in EXPORT_FORMATS:
+        raise RuntimeError(f"Unknown export format '{fmt}'. Use {', '.join(EXPORT_FORMATS)}.")
+    if fmt != "csv" and pa is None:
+        raise RuntimeError(f"{fmt} export needs pyarrow (pip install pyarrow); csv works without it.")
+
+def export_chunks(conn: sqlite3.Connection, kind: str, fmt: str, start_ms: int, end_ms: int, keys: list | None = None):
+    """Yields the encoded export of kind over [start_ms, end_ms) in fmt (see check_export_format), one non-empty chunk per batch."""
+    batches = iter_export_batches(conn, kind, start_ms, end_ms, keys)
+
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(CSV_COLUMNS[kind])
+        for batch in batches:
+            writer.writerows((us_to_iso(row[0]), *row[1:]) for row in batch)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")  # Header of an empty export
+        return
+
+    schema = arrow_schema(kind)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema) if fmt == "parquet" else pa.ipc.new_stream(sink, schema)
+    try:
+        for batch in batches:
+            writer.write_batch(arrow_batch(schema, batch))
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        writer.close()
+    chunk = sink.drain()
+    if chunk:
+        yield chunk  # Parquet footer / Arrow end-of-stream marker
+
+def export_filename(kind: str, fmt: str, start_ms: int, end_ms: int) -> str:
+    first = datetime.fromtimestamp(start_ms / 1000).strftime("%Y%m%d")
+    last = datetime.fromtimestamp((end_ms - 1) / 1000).strftime("%Y%m%d")
+    return f"{kind}_{first}-{last}.{EXPORT_FORMATS[fmt][1]}"
+
+
+# ==================== Main Execution ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Export greenhouse_data.db readings or fan logs as CSV, Parquet or Arrow.")
+    parser.add_argument("kind", choices=EXPORT_KINDS)
+    parser.add_argument("--db", default=DB_NAME, help="Path to the controller database.")
+    parser.add_argument("--format", default="csv", choices=list(EXPORT_FORMATS))
+    parser.add_argument("--start", help="Local start time (ISO, inclusive). Default: --hours before --end.")
+    parser.add_argument("--end", help="Local end time (ISO, exclusive). Default: now.")
+    parser.add_argument("--hours", type=float, default=24, help="Range length when --start is not given.")
+    parser.add_argument("--keys", help="Comma-separated sensor keys to export (readings only, default all).")
+    parser.add_argument("--out", help="Output file (default <kind>_<first>-<last>.<ext>; - for stdout).")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"[Export] Database not found: {args.db}", file=sys.stderr)
+        return 1
+    try:
+        check_export_format(args.format)
+    except RuntimeError as e:
+        print(f"[Export] {e}", file=sys.stderr)
+        return 1
+    end = datetime.fromisoformat(args.end) if args.end else datetime.now()
+    start = datetime.fromisoformat(args.start) if args.start else end - timedelta(hours=args.hours)
+    start_ms, end_ms = int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    keys = [key.strip().lower() for key in args.keys.split(",") if key.strip()] if args.keys else None
+    out_path = args.out or export_filename(args.kind, args.format, start_ms, end_ms)
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    conn.execute("PRAGMA query_only=ON")
+    out = sys.stdout.buffer if out_path == "-" else open(out_path, "wb")
+    written = 0
+    try:
+        for chunk in export_chunks(conn, args.kind, args.format, start_ms, end_ms, keys):
+            out.write(chunk)
+            written += len(chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        conn.close()
+    if out_path != "-":
+        print(f"[Export] Wrote {written / 1e6:.1f} MB of {args.kind} ({start:%Y-%m-%d %H:%M} .. {end:%Y-%m-%d %H:%M}) to {out_path}.",
+              file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
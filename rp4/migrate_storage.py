@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Converts the legacy sensor_readings table of greenhouse_data.db to the compact series/readings layout.
+
+    python3 migrate_storage.py --db greenhouse_data.db
+    python3 migrate_storage.py --db greenhouse_data.db --vacuum
+
+Safe to run while mqtt_localSQL.py is running: rows are moved in short chunked transactions
+(copied, then deleted from the legacy table), so the tool can be interrupted and resumed, and
+freed pages are reused by the new table instead of doubling the file size.
+Start the updated mqtt_localSQL.py once first so that schema migration 4 has created the new tables.
+"""
+import argparse
+import os
+import sqlite3
+import time
+
+DB_NAME = "greenhouse_data.db"
+CHUNK_ROWS = 20000
+MIN_SCHEMA_VERSION = 4  # mqtt_localSQL.py migration that creates series/readings
+
+# Legacy timestamps are naive local-time ISO strings; 'utc' converts them from local time
+# so the result matches the controller's epoch-millisecond timestamps.
+COPY_CHUNK_SQL = """
+    INSERT OR IGNORE INTO readings (series_id, ts, value)
+    SELECT s.id, CAST(ROUND((julianday(r.timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER), r.value
+    FROM sensor_readings r JOIN series s ON s.topic = r.topic AND s.value_key = r.value_key
+    WHERE r.id BETWEEN ? AND ?
+"""
+
+
+# ==================== Migration ====================
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30)
+    conn.isolation_level = None  # Explicit transactions, one per chunk
+    return conn
+
+def table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def check_schema(conn: sqlite3.Connection) -> bool:
+    if not table_exists(conn, "schema_version"):
+        version = 0
+    else:
+        version = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+    if version < MIN_SCHEMA_VERSION:
+        print(f"[Migrate] Schema version is {version}; start the updated mqtt_localSQL.py once to reach "
+              f"version {MIN_SCHEMA_VERSION}, then rerun this tool.")
+        return False
+    return True
+
+def move_chunk(conn: sqlite3.Connection, first_id: int, last_id: int) -> int:
+    """Copies legacy rows first_id..last_id into readings and deletes them, in one transaction."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            "INSERT OR IGNORE INTO series (topic, value_key) SELECT DISTINCT topic, value_key FROM sensor_readings WHERE id BETWEEN ? AND ?",
+            (first_id, last_id)
+        )
+        copied = conn.execute(COPY_CHUNK_SQL, (first_id, last_id)).rowcount
+        conn.execute("DELETE FROM sensor_readings WHERE id BETWEEN ? AND ?", (first_id, last_id))
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        conn.execute("ROLLBACK")
+        raise
+    return copied
+
+def migrate(path: str, chunk_rows: int, pause: float, vacuum: bool):
+    if not os.path.exists(path):
+        print(f"[Migrate] Database not found: {path}")
+        return
+    conn = connect(path)
+    try:
+        if not check_schema(conn):
+            return
+        if not table_exists(conn, "sensor_readings"):
+            print("[Migrate] No legacy sensor_readings table: nothing to convert.")
+        else:
+            size_before = os.path.getsize(path)
+            first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM sensor_readings").fetchone()
+            total = 0
+            started = time.monotonic()
+            if first_id is not None:
+                print(f"[Migrate] Converting legacy rows {first_id}..{last_id} in chunks of {chunk_rows} ...")
+                for chunk_start in range(first_id, last_id + 1, chunk_rows):
+                    total += move_chunk(conn, chunk_start, min(chunk_start + chunk_rows - 1, last_id))
+                    print(f"    {min(chunk_start + chunk_rows - 1, last_id) - first_id + 1}/{last_id - first_id + 1} ids done, {total} readings copied", end="\r")
+                    if pause:
+                        time.sleep(pause)  # Leave the disk to the live controller between chunks
+                print()
+
+            conn.execute("DROP TABLE sensor_readings")
+            print(f"[Migrate] Copied {total} readings in {time.monotonic() - started:.1f}s and dropped sensor_readings "
+                  f"(file size {size_before / 1e6:.1f} MB).")
+
+        if vacuum:
+            # Not online: VACUUM holds a write lock on the whole file while it rebuilds it
+            print("[Migrate] Vacuuming ...")
+            conn.execute("VACUUM")
+        print(f"[Migrate] Done. File size now {os.path.getsize(path) / 1e6:.1f} MB.")
+        print("[Migrate] Restart mqtt_localSQL.py to build history rollups for the converted readings.")
+    finally:
+        conn.close()
+
+
+# ==================== Main Execution ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert greenhouse_data.db sensor_readings to the compact series/readings layout.")
+    parser.add_argument("--db", default=DB_NAME, help="Path to the controller database.")
+    parser.add_argument("--chunk", type=int, default=CHUNK_ROWS, help="Legacy ids moved per transaction.")
+    parser.add_argument("--pause", type=float, default=0.05, help="Seconds to pause between chunks.")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return freed space to the filesystem (briefly blocks writers).")
+    args = parser.parse_args()
+    migrate(args.db, args.chunk, args.pause, args.vacuum)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 import json
 import asyncio
+import math
+import queue
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import requests
+from requests.adapters import HTTPAdapter
 import paho.mqtt.client as mqtt
+try:
+    import msgpack  # Optional: MessagePack sensor payloads
+except ImportError:
+    msgpack = None
 import RPi.GPIO as GPIO
 
 # ==================== Configuration & Globals ====================
@@ -15,12 +28,55 @@ CLIENT_ID = "pi_controller"
 # Replace with your actual CentOS server IP
 REMOTE_API_BASE = "http://192.168.1.217/api/public/v1" 
 
+# Metrics: Prometheus text format served by a small built-in HTTP listener
+METRICS_PORT = 9100
+
+# Remote API transport: one pooled keep-alive session shared by every remote call
+API_POOL_SIZE = 4              # Keep-alive connections kept open to the backend
+API_TIMEOUTS = {               # Per-endpoint (connect, read) timeouts in seconds
+    "/profiles/active": (2, 5),
+    "/config/soil": (2, 5),
+    "/sensors/batch": (2, 5),
+}
+API_DEFAULT_TIMEOUT = (2, 2)
+API_MAX_RETRIES = 1            # Retries per request for network errors...
+API_RETRY_RATIO = 0.1          # ...drawn from a budget where each request earns 0.1 retries...
+API_RETRY_BUDGET_MAX = 10.0    # ...up to this many banked retries
+API_BREAKER_THRESHOLD = 5      # Consecutive failures before the circuit opens
+API_BREAKER_COOLDOWN = 30.0    # Seconds the circuit stays open before a trial request
+
+# Upload pipeline: readings and actuator events are queued and shipped by a background worker
+UPLOAD_QUEUE_MAX = 1000      # Bounded queue size; the oldest entry is dropped when full
+UPLOAD_BATCH_SIZE = 50       # Flush as soon as this many readings are pending
+UPLOAD_FLUSH_INTERVAL = 5.0  # ...or when the oldest pending reading is this old (seconds)
+
+# Store-and-forward spool: requests that fail while the API is unreachable are kept on disk and replayed
+SPOOL_DB = "upload_spool.db"
+SPOOL_MAX_BYTES = 50 * 1024 * 1024  # Oldest entries are evicted beyond this size
+SPOOL_REPLAY_MAX_READINGS = 500     # Max sensor readings merged into one replay request
+SPOOL_REPLAY_THROTTLE = 0.2         # Pause between successful replay requests (seconds)
+SPOOL_RETRY_MIN = 1.0               # Initial backoff after a failed replay (seconds)
+SPOOL_RETRY_MAX = 300.0             # Backoff ceiling (seconds)
+SPOOL_IDLE_INTERVAL = 5.0           # How often an empty spool is re-checked (seconds)
+SENSOR_BATCH_PATH = "/sensors/batch"
+
+# Legacy single-greenhouse topics map to DEFAULT_ZONE; additional zones publish on
+# greenhouse/<zone>/sensor/<type> and are picked up by the wildcard subscription
+ZONE_SENSOR_TOPIC = "greenhouse/+/sensor/#"
 TOPICS = [
     "greenhouse/sensor/air_th",
     "greenhouse/sensor/soil",
-    "greenhouse/sensor/light"
+    "greenhouse/sensor/light",
+    ZONE_SENSOR_TOPIC
 ]
 
+# --- Zones ---
+DEFAULT_ZONE = "main"   # Zone driven by this Pi's GPIO pins; other zones are actuated over MQTT
+MAX_ZONES = 32          # Upper bound on zones (one worker thread each)
+ZONE_QUEUE_MAX = 200    # Pending messages per zone; the oldest is dropped when full
+ZONE_CONFIG_TOPIC = "greenhouse/+/config/#"  # Per-zone profile/soil overrides (retained)
+ACTUATOR_TOPIC = "greenhouse/{zone}/actuator/{actuator}"  # Commands for zones without local GPIO
+
 # Fan PWM pin (BCM numbering)
 FAN_INA = 17
 PWM_FREQ = 1000  # Hz
@@ -37,23 +93,30 @@ MISTER_PIN = 26   # Misting/Fogging System
 # Global reference for the MQTT client
 mqtt_client = None 
 
-# Global State
-current_duty = 0
-current_curtain_state = False
-current_pump_state = False
-last_co2 = 0 
-last_log_time = {}
 LOG_INTERVAL = 30 # Log every 30 seconds per topic
-received_topics_for_separator = set()
 
-# State tracking for periodic logging
-last_heater_state = None
-last_mister_state = None
+# Control loop: MQTT ingestion only updates the latest readings; control runs at a fixed rate
+CONTROL_INTERVAL = 1.0       # Seconds between control ticks (1 Hz)
+SENSOR_STALE_AFTER = 120.0   # Readings older than this are not used for control (seconds)
 
-EXPECTED_TOPICS = {
-    "greenhouse/sensor/air_th",
-    "greenhouse/sensor/soil",
-    "greenhouse/sensor/light"
+# Actuator event logging: an event is sent only when an actuator changes state,
+# or as a heartbeat once this many seconds have passed without a change
+ACTUATOR_HEARTBEAT_INTERVAL = 300
+
+# Config topics: pushed (retained) profile and soil calibration updates apply immediately.
+# Publisher: mqtt_localSQL.py (profile and soil calibration), when it runs against the same broker.
+# The PHP backend does not publish, so its profile changes arrive through the conditional poll below.
+CONFIG_PROFILE_TOPIC = "greenhouse/config/profile"
+CONFIG_SOIL_TOPIC = "greenhouse/config/soil"
+CONFIG_TOPICS = [CONFIG_PROFILE_TOPIC, CONFIG_SOIL_TOPIC]
+CONFIG_REFRESH_INTERVAL = 3  # Polling interval (seconds); unchanged config costs a bodiless 304
+
+EXPECTED_SENSOR_TYPES = {"air_th", "soil", "light"}
+
+DEVICE_NAMES = {
+    "air_th": "ESP32 Air_TH Sensor",
+    "soil": "ESP32 Soil Sensor",
+    "light": "ESP32 Light Sensor"
 }
 
 # Cache for configuration (fetched from remote API)
@@ -74,6 +137,21 @@ cached_soil_calib = {
     "wet_adc": 1200
 }
 
+# ETags of the last config responses, for conditional polling
+config_etags = {}
+
+# Upload pipeline state
+upload_queue = queue.Queue(maxsize=UPLOAD_QUEUE_MAX)
+upload_stop_event = threading.Event()
+upload_thread = None
+upload_dropped = 0
+
+# Spool state
+spool_conn = None
+spool_lock = threading.Lock()
+spool_bytes = 0
+spool_thread = None
+
 # ==================== GPIO Setup ====================
 GPIO.setwarnings(False)
 GPIO.setmode(GPIO.BCM)
@@ -86,58 +164,656 @@ for pin in [CURTAIN_PIN, HEATER_PIN, PUMP_PIN, MISTER_PIN]:
     GPIO.setup(pin, GPIO.OUT)
     GPIO.output(pin, GPIO.LOW) # Ensure all systems are OFF initially
 
+# ==================== Metrics ====================
+
+class Metrics:
+    """
+    Minimal in-process metrics registry rendered in Prometheus text format.
+    Counters and latency histograms are keyed by name and labels; gauges are sampled at scrape time.
+    """
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.gauges = {}      # name -> callable returning a number or {labels: number}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        # Label values are stored as strings: render() sorts the keys, and 200 vs "error" would not compare
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        """Times a hot-path stage into greenhouse_stage_seconds{stage=...}."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("greenhouse_stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for k, v in labels:
+            escaped = str(v).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{k}="{escaped}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+
+        def header(name, default_kind):
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted({k[0] for k in counters}):
+            header(name, "counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for name in sorted({k[0] for k in histograms}):
+            header(name, "histogram")
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, hist):
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            header(name, "gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{name}{self._labels(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("greenhouse_stage_seconds", "histogram", "Latency of hot-path stages in seconds.")
+metrics.describe("greenhouse_messages_total", "counter", "MQTT messages received per topic.")
+metrics.describe("greenhouse_errors_total", "counter", "Errors by kind.")
+metrics.describe("greenhouse_gpio_writes_total", "counter", "GPIO output and PWM writes.")
+metrics.describe("greenhouse_http_requests_total", "counter", "Remote API requests by path and status.")
+metrics.describe("greenhouse_db_commits_total", "counter", "SQLite commits by database.")
+metrics.describe("greenhouse_upload_dropped_total", "counter", "Readings and events dropped because the upload queue was full.")
+metrics.describe("greenhouse_zone_queue_dropped_total", "counter", "Readings dropped because a zone's queue was full.")
+metrics.describe("greenhouse_queue_depth", "gauge", "Items waiting in internal queues.")
+metrics.describe("greenhouse_spool_bytes", "gauge", "Bytes of unsent data in the on-disk spool.")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics for Prometheus scrapes."""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    """Starts the /metrics listener on METRICS_PORT in a daemon thread."""
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        print(f"[Metrics Warning] Could not listen on port {METRICS_PORT}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+    print(f"[System] Metrics available on http://0.0.0.0:{METRICS_PORT}/metrics")
+    return server
+
+def queue_depths() -> dict:
+    depths = {(("queue", "upload"),): upload_queue.qsize()}
+    for name, zone in list(zones.items()):
+        depths[(("queue", "zone"), ("zone", name))] = zone.queue.qsize()
+    return depths
+
+metrics.gauge("greenhouse_queue_depth", queue_depths)
+metrics.gauge("greenhouse_spool_bytes", lambda: spool_bytes)
+
+
+# ==================== Remote API Transport ====================
+
+class CircuitOpenError(Exception):
+    """Raised when a request is refused because the backend is considered down."""
+
+# Raised by requests before anything is sent (unencodable body, bad URL or header): not a backend failure
+API_CLIENT_ERRORS = (requests.exceptions.InvalidJSONError, requests.exceptions.URLRequired, ValueError)
+
+# Failures after which a POST may be resent: the connection was never established or was dropped.
+# A read timeout is not among them, since the backend may already have stored the request.
+API_POST_RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout)
+
+class RemoteTransport:
+    """
+    Shared HTTP transport for the remote PHP API.
+    Reuses pooled keep-alive connections, applies per-endpoint timeouts, retries
+    network errors within a retry budget (POSTs only on API_POST_RETRY_ERRORS), and
+    fails fast through a circuit breaker while the backend is down.
+    """
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_SIZE, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.retry_tokens = API_RETRY_BUDGET_MAX
+        self.failures = 0
+        self.opened_at = None  # None while the circuit is closed
+        self.probing = False
+
+    def _acquire(self) -> bool:
+        """Checks the circuit breaker before a request is sent. Returns True if this request is the half-open trial."""
+        with self.lock:
+            self.retry_tokens = min(API_RETRY_BUDGET_MAX, self.retry_tokens + API_RETRY_RATIO)
+            if self.opened_at is None:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < API_BREAKER_COOLDOWN:
+                raise CircuitOpenError(f"Circuit open for {self.base_url}")
+            # Half-open: let a single trial request through
+            self.probing = True
+            return True
+
+    def _record(self, success: bool):
+        with self.lock:
+            self.probing = False
+            if success:
+                if self.opened_at is not None:
+                    print("[API] Backend reachable again, circuit closed.")
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.opened_at is not None or self.failures >= API_BREAKER_THRESHOLD:
+                    if self.opened_at is None:
+                        print(f"[API Warning] {self.failures} consecutive failures, circuit opened for {API_BREAKER_COOLDOWN:.0f}s.")
+                    self.opened_at = time.monotonic()
+
+    def _take_retry(self) -> bool:
+        with self.lock:
+            if self.retry_tokens >= 1:
+                self.retry_tokens -= 1
+                return True
+            return False
+
+    def request(self, method: str, path: str, timeout=None, **kwargs) -> requests.Response:
+        """
+        Sends a request to base_url + path. Raises CircuitOpenError or requests exceptions on failure.
+        Only transport failures and 5xx responses count towards the breaker; errors raised before
+        anything is sent (API_CLIENT_ERRORS, or any non-requests exception) are passed through uncounted.
+        """
+        probe = self._acquire()
+        timeout = timeout or API_TIMEOUTS.get(path, API_DEFAULT_TIMEOUT)
+        url = f"{self.base_url}{path}"
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    with metrics.time("http"):
+                        resp = self.session.request(method, url, timeout=timeout, **kwargs)
+                except API_CLIENT_ERRORS:
+                    metrics.inc("greenhouse_errors_total", kind="http_client")
+                    raise
+                except requests.RequestException as e:
+                    metrics.inc("greenhouse_http_requests_total", path=path, status="error")
+                    attempt += 1
+                    retryable = method == "GET" or isinstance(e, API_POST_RETRY_ERRORS)
+                    if retryable and attempt <= API_MAX_RETRIES and self.opened_at is None and self._take_retry():
+                        continue
+                    self._record(False)
+                    metrics.inc("greenhouse_errors_total", kind="http")
+                    raise
+                metrics.inc("greenhouse_http_requests_total", path=path, status=str(resp.status_code))
+                self._record(resp.status_code < 500)
+                return resp
+        finally:
+            if probe:
+                # An uncounted error must not leave the circuit stuck half-open
+                with self.lock:
+                    self.probing = False
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+api = RemoteTransport(REMOTE_API_BASE)
+
 
 # ==================== Remote API Functions ====================
 
+def apply_profile(data: dict, source: str, zone=None):
+    """
+    Applies an active-profile document ({"profile_name": ..., "setpoints": {...}}).
+    Without a zone it updates the shared setpoints; with a zone it replaces that zone's overrides.
+    """
+    global cached_setpoints
+    if 'setpoints' not in data or not isinstance(data['setpoints'], dict):
+        return
+    # Swap in a new dict so the control loop never sees a half-updated one
+    if zone is None:
+        cached_setpoints = {**cached_setpoints, **data['setpoints']}
+        setpoints = cached_setpoints
+    else:
+        zone.setpoint_overrides = dict(data['setpoints'])
+        setpoints = zone.setpoints
+    target = f" for zone '{zone.name}'" if zone else ""
+    print(f"[{source}] Updated setpoints{target} from profile: {data.get('profile_name', 'Unknown')}")
+    print(f"      Setpoints: {json.dumps(setpoints, indent=2)}")
+
+def apply_soil_calibration(dry_adc, wet_adc, source: str, zone=None):
+    """Applies soil sensor calibration values to the shared calibration or to one zone."""
+    global cached_soil_calib
+    calib = {'dry_adc': float(dry_adc), 'wet_adc': float(wet_adc)}
+    if zone is None:
+        cached_soil_calib = calib
+    else:
+        zone.soil_calib_override = calib
+    target = f" for zone '{zone.name}'" if zone else ""
+    print(f"[{source}] Updated soil calibration{target}.")
+    print(f"      Calibration: {json.dumps(calib, indent=2)}")
+
 def fetch_remote_config():
-    """Fetches the active profile and calibration from the remote PHP API."""
-    global cached_setpoints, cached_soil_calib
-    
+    """
+    Fetches the active profile and calibration from the remote PHP API.
+    Uses conditional requests (If-None-Match), so unchanged config costs a 304 with no body.
+    Blocking: call from a worker thread, never from the asyncio loop or the MQTT network thread.
+    """
     # 1. Fetch Active Profile
     try:
-        resp = requests.get(f"{REMOTE_API_BASE}/profiles/active", timeout=5)
+        resp = api.get("/profiles/active", headers=conditional_headers("/profiles/active"))
         if resp.status_code == 200:
-            data = resp.json()
-            if 'setpoints' in data:
-                cached_setpoints.update(data['setpoints'])
-                print(f"[API] Updated setpoints from profile: {data.get('profile_name', 'Unknown')}")
-                print(f"      Setpoints: {json.dumps(cached_setpoints, indent=2)}")
+            config_etags["/profiles/active"] = resp.headers.get("ETag")
+            apply_profile(resp.json(), "API")
+    except CircuitOpenError:
+        return  # Backend down: already logged by the transport, retried on the next poll
     except Exception as e:
         print(f"[API Warning] Failed to fetch profile: {e}")
 
     # 2. Fetch Soil Calibration
     try:
-        resp = requests.get(f"{REMOTE_API_BASE}/config/soil", timeout=5)
+        resp = api.get("/config/soil", headers=conditional_headers("/config/soil"))
         if resp.status_code == 200:
+            config_etags["/config/soil"] = resp.headers.get("ETag")
             data = resp.json()
             # Ensure keys match what the PHP API returns
             if 'dry_adc' in data and 'wet_adc' in data:
-                cached_soil_calib['dry_adc'] = float(data['dry_adc'])
-                cached_soil_calib['wet_adc'] = float(data['wet_adc'])
-                print(f"[API] Updated soil calibration.")
-                print(f"      Calibration: {json.dumps(cached_soil_calib, indent=2)}")
+                apply_soil_calibration(data['dry_adc'], data['wet_adc'], "API")
+    except CircuitOpenError:
+        pass
     except Exception as e:
         print(f"[API Warning] Failed to fetch soil calibration: {e}")
 
-def upload_sensor_data(topic: str, payload: dict):
-    """Uploads sensor data to the remote PHP API."""
+def conditional_headers(path: str) -> dict:
+    """Returns If-None-Match headers for a config endpoint whose ETag we have seen."""
+    etag = config_etags.get(path)
+    return {"If-None-Match": etag} if etag else {}
+
+def refresh_config_in_background():
+    """Runs fetch_remote_config on a short-lived thread so the caller is not blocked."""
+    threading.Thread(target=fetch_remote_config, name="config_fetch", daemon=True).start()
+
+def handle_config_message(topic: str, data: dict):
+    """
+    Applies configuration pushed over MQTT (retained messages are delivered on subscribe).
+    greenhouse/config/<kind> applies to every zone, greenhouse/<zone>/config/<kind> to one zone.
+    """
+    parts = topic.split("/")
+    zone = None
+    if len(parts) == 4:
+        zone = get_zone(parts[1])
+        if zone is None:
+            return
+    kind = parts[-1]
+
     try:
-        # Prepare data for the PHP backend
-        # The PHP backend likely expects a POST with 'topic' and 'payload' (or flattened data)
-        data_to_send = {
-            "topic": topic,
-            "timestamp": datetime.now().isoformat(),
-            "data": payload
-        }
-        
-        # Fire and forget (with short timeout) to not block control loop too long
-        # In a production system, you might use a queue or async HTTP client
-        resp = requests.post(f"{REMOTE_API_BASE}/sensors", json=data_to_send, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Upload failed: {resp.status_code} - {resp.text}")
-        
+        if kind == "profile":
+            apply_profile(data, "MQTT", zone)
+        elif kind == "soil":
+            # Accept both the API shape and the ESP32 CALIBRATE_SOIL command shape
+            dry = data.get('dry_adc', data.get('dry'))
+            wet = data.get('wet_adc', data.get('wet'))
+            if dry is not None and wet is not None:
+                apply_soil_calibration(dry, wet, "MQTT", zone)
+    except (ValueError, TypeError) as e:
+        print(f"[MQTT Warning] Invalid config on {topic}: {e}")
+
+def json_safe(value):
+    """Copy of value with NaN/inf floats replaced by None: the backend only accepts strict JSON."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    return value
+
+def encode_json(payload) -> str | None:
+    """Serializes an API payload once, as strict JSON. Returns None (logged) if it cannot be encoded, e.g. bytes values."""
+    try:
+        return json.dumps(json_safe(payload), allow_nan=False)
+    except (TypeError, ValueError) as e:
+        metrics.inc("greenhouse_errors_total", kind="encode")
+        print(f"[API Warning] Dropping unencodable payload: {e}")
+        return None
+
+def post_to_api(path: str, body: str, timeout=None) -> bool:
+    """
+    POSTs an encoded JSON body (see encode_json) to the remote API through the shared transport.
+    Returns False only if the request should be retried later (connection error, timeout, open circuit or 5xx);
+    anything else, such as a 4xx rejection, is logged and not retried.
+    """
+    try:
+        resp = api.post(path, data=body.encode("utf-8"), headers={"Content-Type": "application/json"}, timeout=timeout)
+        if resp.status_code == 200:
+            return True
+        print(f"[API Error] POST {path} failed: {resp.status_code} - {resp.text}")
+        return resp.status_code < 500
+    except (CircuitOpenError, requests.ConnectionError, requests.Timeout):
+        return False
     except Exception as e:
-        print(f"[API Error] Failed to upload data: {e}")
+        metrics.inc("greenhouse_errors_total", kind="http_dropped")
+        print(f"[API Error] POST {path} failed, not retrying: {e}")
+        return True
+
+def enqueue_upload(path: str, body: str):
+    """Queues an encoded request body for the upload worker (never blocks the caller)."""
+    global upload_dropped
+    item = (path, body)
+    try:
+        upload_queue.put_nowait(item)
+    except queue.Full:
+        # Backend is falling behind: drop the oldest entry to make room for the newest
+        try:
+            upload_queue.get_nowait()
+        except queue.Empty:
+            pass
+        upload_dropped += 1
+        metrics.inc("greenhouse_upload_dropped_total")
+        if upload_dropped % 100 == 1:
+            print(f"[API Warning] Upload queue full, dropped {upload_dropped} entries so far.")
+        try:
+            upload_queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+def upload_sensor_data(topic: str, payload: dict):
+    """Queues sensor data for upload to the remote PHP API (never blocks the caller)."""
+    reading = encode_json({
+        "topic": topic,
+        "timestamp": datetime.now().isoformat(),
+        "data": payload
+    })
+    if reading is not None:
+        enqueue_upload(SENSOR_BATCH_PATH, reading)
+
+def post_sensor_batch(batch: list):
+    """Sends a batch of queued (encoded) readings to the bulk ingest endpoint, spooling it on failure."""
+    readings = ",".join(batch)
+    if not post_to_api(SENSOR_BATCH_PATH, f'{{"readings": [{readings}]}}'):
+        spool_append(SENSOR_BATCH_PATH, f"[{readings}]")
+
+def post_upload_event(path: str, body: str):
+    """Sends one queued actuator event, spooling it on failure."""
+    if not post_to_api(path, body):
+        spool_append(path, body)
+
+def upload_worker():
+    """
+    Background worker that drains the upload queue.
+    Actuator events are sent as they arrive. Readings are batched: a batch is flushed when it reaches
+    UPLOAD_BATCH_SIZE or when its oldest reading has waited UPLOAD_FLUSH_INTERVAL seconds, whichever comes first.
+    """
+    batch = []
+    deadline = None
+
+    while True:
+        if upload_stop_event.is_set() and upload_queue.empty():
+            break
+
+        timeout = UPLOAD_FLUSH_INTERVAL if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            path, body = upload_queue.get(timeout=min(timeout, 1.0))
+        except queue.Empty:
+            path = None
+
+        if path == SENSOR_BATCH_PATH:
+            if not batch:
+                deadline = time.monotonic() + UPLOAD_FLUSH_INTERVAL
+            batch.append(body)
+        elif path is not None:
+            try:
+                post_upload_event(path, body)
+            except Exception as e:
+                metrics.inc("greenhouse_errors_total", kind="upload")
+                print(f"[Upload Error] Dropped an event for {path}: {e}")
+
+        if batch and (len(batch) >= UPLOAD_BATCH_SIZE or time.monotonic() >= deadline):
+            try:
+                post_sensor_batch(batch)
+            except Exception as e:
+                # Keep the worker alive: an unexpected error loses this batch, not every later reading
+                metrics.inc("greenhouse_errors_total", kind="upload")
+                print(f"[Upload Error] Dropped a batch of {len(batch)} readings: {e}")
+            batch = []
+            deadline = None
+
+    if batch:
+        try:
+            post_sensor_batch(batch)
+        except Exception as e:
+            print(f"[Upload Error] Dropped a batch of {len(batch)} readings: {e}")
+
+def start_upload_worker():
+    """Starts the background upload worker thread."""
+    global upload_thread
+    upload_stop_event.clear()
+    upload_thread = threading.Thread(target=upload_worker, name="upload_worker", daemon=True)
+    upload_thread.start()
+
+def stop_upload_worker(timeout: float = 10.0):
+    """Signals the upload worker to flush pending readings and waits for it to exit."""
+    upload_stop_event.set()
+    if upload_thread is not None:
+        upload_thread.join(timeout)
+
+
+
+# ==================== Store-and-Forward Spool ====================
+
+def init_spool():
+    """Opens the on-disk spool (SQLite in WAL mode) and starts the replay worker."""
+    global spool_conn, spool_bytes, spool_thread
+    spool_conn = sqlite3.connect(SPOOL_DB, check_same_thread=False)
+    spool_conn.execute("PRAGMA journal_mode=WAL")
+    spool_conn.execute("PRAGMA synchronous=NORMAL")
+    spool_conn.execute("""
+        CREATE TABLE IF NOT EXISTS spool (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, payload TEXT NOT NULL, size INTEGER NOT NULL
+        )
+    """)
+    spool_conn.commit()
+    spool_bytes = spool_conn.execute("SELECT COALESCE(SUM(size), 0) FROM spool").fetchone()[0]
+    if spool_bytes:
+        print(f"[Spool] {spool_bytes} bytes of unsent data pending replay.")
+
+    spool_thread = threading.Thread(target=spool_replay_worker, name="spool_replay", daemon=True)
+    spool_thread.start()
+
+def spool_append(path: str, data: str):
+    """Appends an unsent request (encoded JSON body) to the spool, evicting the oldest entries beyond SPOOL_MAX_BYTES."""
+    global spool_bytes
+    if spool_conn is None:
+        return
+
+    with spool_lock:
+        try:
+            spool_conn.execute("INSERT INTO spool (path, payload, size) VALUES (?, ?, ?)", (path, data, len(data)))
+            spool_bytes += len(data)
+
+            while spool_bytes > SPOOL_MAX_BYTES:
+                row = spool_conn.execute("SELECT id, size FROM spool ORDER BY id LIMIT 1").fetchone()
+                if row is None:
+                    spool_bytes = 0
+                    break
+                spool_conn.execute("DELETE FROM spool WHERE id = ?", (row[0],))
+                spool_bytes -= row[1]
+                print(f"[Spool] Size cap reached, evicted oldest entry ({row[1]} bytes).")
+
+            spool_conn.commit()
+            metrics.inc("greenhouse_db_commits_total", db="spool")
+        except sqlite3.Error as e:
+            print(f"[Spool Error] Failed to spool {path}: {e}")
+
+def spool_next_batch() -> tuple[str, str, list] | None:
+    """
+    Returns the next replay request as (path, body, ids), preserving spool order.
+    Consecutive sensor batches are merged into one bulk request of up to SPOOL_REPLAY_MAX_READINGS readings;
+    a sensor batch that is not a valid JSON array is removed from the spool instead of blocking it.
+    """
+    with spool_lock:
+        rows = spool_conn.execute("SELECT id, path, payload FROM spool ORDER BY id LIMIT 100").fetchall()
+    if not rows:
+        return None
+
+    first_id, path, payload = rows[0]
+    if path != SENSOR_BATCH_PATH:
+        return path, payload, [first_id]
+
+    parts = []
+    count = 0
+    ids = []
+    bad_ids = []
+    for row_id, row_path, row_payload in rows:
+        if row_path != SENSOR_BATCH_PATH:
+            break
+        try:
+            size = len(json.loads(row_payload))
+        except (ValueError, TypeError):
+            bad_ids.append(row_id)
+            continue
+        if ids and count + size > SPOOL_REPLAY_MAX_READINGS:
+            break
+        if size:
+            parts.append(row_payload.strip()[1:-1])
+        count += size
+        ids.append(row_id)
+    if bad_ids:
+        print(f"[Spool Error] Dropping {len(bad_ids)} corrupt spooled batches.")
+        spool_delete(bad_ids)
+    if not ids:
+        return None
+    return path, f'{{"readings": [{",".join(parts)}]}}', ids
+
+def spool_delete(ids: list):
+    """Removes replayed entries from the spool."""
+    global spool_bytes
+    placeholders = ",".join("?" * len(ids))
+    with spool_lock:
+        try:
+            freed = spool_conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM spool WHERE id IN ({placeholders})", ids).fetchone()[0]
+            spool_conn.execute(f"DELETE FROM spool WHERE id IN ({placeholders})", ids)
+            spool_conn.commit()
+            metrics.inc("greenhouse_db_commits_total", db="spool")
+            spool_bytes = max(0, spool_bytes - freed)
+        except sqlite3.Error as e:
+            print(f"[Spool Error] Failed to remove replayed entries: {e}")
+
+def spool_replay_worker():
+    """
+    Replays spooled requests in order once the API is reachable again.
+    Failures back off exponentially (SPOOL_RETRY_MIN .. SPOOL_RETRY_MAX); successful
+    requests are throttled by SPOOL_REPLAY_THROTTLE so replay does not starve live uploads.
+    """
+    backoff = SPOOL_RETRY_MIN
+
+    while not upload_stop_event.is_set():
+        try:
+            item = spool_next_batch()
+            if item is None:
+                upload_stop_event.wait(SPOOL_IDLE_INTERVAL)
+                continue
+
+            # post_to_api is False only for retryable failures; rejected requests are dropped like delivered ones
+            path, body, ids = item
+            if post_to_api(path, body, timeout=(2, 10)):
+                spool_delete(ids)
+                backoff = SPOOL_RETRY_MIN
+                upload_stop_event.wait(SPOOL_REPLAY_THROTTLE)
+            else:
+                print(f"[Spool] Replay failed, retrying in {backoff:.0f}s ({spool_bytes} bytes pending).")
+                upload_stop_event.wait(backoff)
+                backoff = min(backoff * 2, SPOOL_RETRY_MAX)
+        except Exception as e:
+            # Keep the worker alive (e.g. a locked or corrupt spool database) and try again later
+            metrics.inc("greenhouse_errors_total", kind="spool")
+            print(f"[Spool Error] Replay pass failed: {e}")
+            upload_stop_event.wait(SPOOL_IDLE_INTERVAL)
+
+def close_spool():
+    """Stops the replay worker and closes the spool database."""
+    global spool_conn
+    if spool_thread is not None:
+        spool_thread.join(5.0)
+    with spool_lock:
+        if spool_conn is not None:
+            spool_conn.close()
+            spool_conn = None
 
 
 # ==================== Helper Functions: Math ====================
@@ -164,120 +840,209 @@ def calculate_vpd(T: float, RH: float) -> float | None:
         return None
 
 
+# ==================== Zones ====================
+
+class Zone:
+    """
+    Per-greenhouse state: latest readings, setpoint overrides, actuator state and event filter.
+    Each zone has its own worker thread, so a zone blocked on I/O never holds up the others
+    (the workers still share one interpreter, so CPU-bound work does not run in parallel).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.local = name == DEFAULT_ZONE  # Only the default zone drives this Pi's GPIO pins
+        self.queue = queue.Queue(maxsize=ZONE_QUEUE_MAX)
+        self.sensor_state = SensorState()
+        self.setpoint_overrides = {}
+        self.soil_calib_override = None
+        self.current_duty = 0
+        self.last_co2 = 0
+        self.output_states = {}  # Last commanded state per output (zones actuated over MQTT)
+        self.events = ActuatorEventLog(ACTUATOR_HEARTBEAT_INTERVAL)
+        self.last_control_seq = {}
+        self.last_control_log_time = {}
+        self.last_log_time = {}
+        self.received_types = set()
+        self.dropped = 0  # Readings discarded from the full queue (only on_message touches it)
+        self.thread = None
+
+    @property
+    def setpoints(self) -> dict:
+        """Shared profile setpoints with this zone's overrides applied."""
+        if not self.setpoint_overrides:
+            return cached_setpoints
+        return {**cached_setpoints, **self.setpoint_overrides}
+
+    @property
+    def soil_calib(self) -> dict:
+        return self.soil_calib_override or cached_soil_calib
+
+zones = {}
+zones_lock = threading.Lock()
+control_stop_event = threading.Event()
+
+def get_zone(name: str) -> Zone | None:
+    """Returns the zone with this name, creating it and starting its worker on first use."""
+    zone = zones.get(name)
+    if zone is not None:
+        return zone
+
+    with zones_lock:
+        zone = zones.get(name)
+        if zone is None:
+            if len(zones) >= MAX_ZONES:
+                print(f"[Zone Warning] Zone limit ({MAX_ZONES}) reached, ignoring zone '{name}'.")
+                return None
+            zone = Zone(name)
+            zone.thread = threading.Thread(target=zone_worker, args=(zone,), name=f"zone_{name}", daemon=True)
+            zones[name] = zone
+            zone.thread.start()
+            print(f"[Zone] Started worker for zone '{name}'.")
+    return zone
+
+def stop_zone_workers():
+    """Stops all zone workers and waits for their current work to finish."""
+    control_stop_event.set()
+    for zone in list(zones.values()):
+        zone.thread.join(5.0)
+
+
 # ==================== GPIO Control Functions ====================
 
-def set_output_state(pin: int, state: bool, system_name: str):
-    """Generic function to set GPIO output state and log the action."""
-    target_state = GPIO.HIGH if state else GPIO.LOW
-    
-    if GPIO.input(pin) != target_state:
-        GPIO.output(pin, target_state)
-        status = "ON" if state else "OFF"
-        print(f"      [{system_name}] Switched {status}")
+def set_output_state(zone: Zone, pin: int, state: bool, system_name: str):
+    """
+    Generic function to set an output state and log the action.
+    The local zone switches its GPIO pin; other zones get a retained MQTT command.
+    """
+    if zone.local:
+        target_state = GPIO.HIGH if state else GPIO.LOW
+        if GPIO.input(pin) == target_state:
+            return
+        with metrics.time("gpio_write"):
+            GPIO.output(pin, target_state)
+        metrics.inc("greenhouse_gpio_writes_total")
+    else:
+        if zone.output_states.get(system_name) == state:
+            return
+        zone.output_states[system_name] = state
+        publish_actuator_command(zone, system_name, {"state": "ON" if state else "OFF"})
 
-def log_fan_state(duty_cycle: int):
+    status = "ON" if state else "OFF"
+    print(f"      [{zone.name}/{system_name}] Switched {status}")
+
+def publish_actuator_command(zone: Zone, actuator: str, command: dict):
+    """Publishes an actuator command for a zone that is not wired to this Pi."""
+    if mqtt_client is None:
+        return
+    topic = ACTUATOR_TOPIC.format(zone=zone.name, actuator=actuator.lower())
+    mqtt_client.publish(topic, json.dumps(command), qos=1, retain=True)
+
+class ActuatorEventLog:
     """
-    Logs the fan state. 
-    In this headless version, we could upload this event to the API too if needed.
-    For now, we just print it.
+    Change-detection filter shared by all actuator log helpers.
+    An event passes when the actuator's state differs from the last emitted one,
+    or when the heartbeat interval has elapsed since that emission.
     """
+
+    def __init__(self, heartbeat_interval: float):
+        self.heartbeat_interval = heartbeat_interval
+        self.last_emitted = {}  # actuator name -> (state, monotonic time)
+        self.lock = threading.Lock()
+
+    def should_emit(self, actuator: str, state) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_emitted.get(actuator)
+            if last is not None and last[0] == state and now - last[1] < self.heartbeat_interval:
+                return False
+            self.last_emitted[actuator] = (state, now)
+            return True
+
+def emit_actuator_event(zone: Zone, actuator: str, state, path: str, payload: dict):
+    """Queues an actuator log event for the upload worker if it passes change detection (never blocks control)."""
+    if not zone.events.should_emit(actuator, state):
+        return
+    payload["zone"] = zone.name
+    body = encode_json(payload)
+    if body is not None:
+        enqueue_upload(path, body)
+
+def log_fan_state(zone: Zone, duty_cycle: int):
+    """Logs the fan duty cycle to the API when it changes (or on heartbeat)."""
     status = "ON" if duty_cycle > 0 else "OFF"
-    # Upload fan state change to API
-    try:
-        payload = {
-            "duty_cycle": duty_cycle, 
-            "status": status,
-            "timestamp": datetime.now().isoformat()
-        }
-        resp = requests.post(f"{REMOTE_API_BASE}/fan/log", json=payload, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Failed to upload fan log: {resp.status_code} - {resp.text}")
-    except Exception as e:
-        print(f"[API Error] Failed to upload fan log: {e}")
+    payload = {
+        "duty_cycle": duty_cycle,
+        "status": status,
+        "timestamp": datetime.now().isoformat()
+    }
+    emit_actuator_event(zone, "fan", duty_cycle, "/fan/log", payload)
 
-def log_curtain_state(state: bool, lux: float):
-    """Logs the curtain state change to the API."""
+def log_curtain_state(zone: Zone, state: bool, lux: float):
+    """Logs the curtain state to the API when it changes (or on heartbeat)."""
     status = "ON" if state else "OFF"
-    try:
-        payload = {
-            "status": status,
-            "lux": lux,
-            "timestamp": datetime.now().isoformat()
-        }
-        resp = requests.post(f"{REMOTE_API_BASE}/curtain/log", json=payload, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Failed to upload curtain log: {resp.status_code} - {resp.text}")
-    except Exception as e:
-        print(f"[API Error] Failed to upload curtain log: {e}")
+    payload = {
+        "status": status,
+        "lux": lux,
+        "timestamp": datetime.now().isoformat()
+    }
+    emit_actuator_event(zone, "curtain", state, "/curtain/log", payload)
 
-def log_irrigation_state(state: bool, moisture: float):
-    """Logs the irrigation pump state change to the API."""
+def log_irrigation_state(zone: Zone, state: bool, moisture: float):
+    """Logs the irrigation pump state to the API when it changes (or on heartbeat)."""
     status = "ON" if state else "OFF"
-    try:
-        payload = {
-            "status": status,
-            "soil_moisture": moisture,
-            "timestamp": datetime.now().isoformat()
-        }
-        resp = requests.post(f"{REMOTE_API_BASE}/irrigation/log", json=payload, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Failed to upload irrigation log: {resp.status_code} - {resp.text}")
-    except Exception as e:
-        print(f"[API Error] Failed to upload irrigation log: {e}")
+    payload = {
+        "status": status,
+        "soil_moisture": moisture,
+        "timestamp": datetime.now().isoformat()
+    }
+    emit_actuator_event(zone, "irrigation", state, "/irrigation/log", payload)
 
-def log_heater_state(state: bool, temp: float):
-    """Logs the heater state change to the API."""
+def log_heater_state(zone: Zone, state: bool, temp: float):
+    """Logs the heater state to the API when it changes (or on heartbeat)."""
     status = "ON" if state else "OFF"
-    try:
-        payload = {
-            "status": status,
-            "temp": temp,
-            "timestamp": datetime.now().isoformat()
-        }
-        resp = requests.post(f"{REMOTE_API_BASE}/heater/log", json=payload, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Failed to upload heater log: {resp.status_code} - {resp.text}")
-    except Exception as e:
-        print(f"[API Error] Failed to upload heater log: {e}")
+    payload = {
+        "status": status,
+        "temp": temp,
+        "timestamp": datetime.now().isoformat()
+    }
+    emit_actuator_event(zone, "heater", state, "/heater/log", payload)
 
-def log_mister_state(state: bool, vpd: float):
-    """Logs the mister state change to the API."""
+def log_mister_state(zone: Zone, state: bool, vpd: float):
+    """Logs the mister state to the API when it changes (or on heartbeat)."""
     status = "ON" if state else "OFF"
-    try:
-        payload = {
-            "status": status,
-            "vpd": vpd,
-            "timestamp": datetime.now().isoformat()
-        }
-        resp = requests.post(f"{REMOTE_API_BASE}/mister/log", json=payload, timeout=2)
-        if resp.status_code != 200:
-            print(f"[API Error] Failed to upload mister log: {resp.status_code} - {resp.text}")
-    except Exception as e:
-        print(f"[API Error] Failed to upload mister log: {e}")
+    payload = {
+        "status": status,
+        "vpd": vpd,
+        "timestamp": datetime.now().isoformat()
+    }
+    emit_actuator_event(zone, "mister", state, "/mister/log", payload)
 
-def set_fan_duty(duty: int):
-    """Sets the fan PWM duty cycle."""
-    global current_duty
+def set_fan_duty(zone: Zone, duty: int):
+    """Sets the fan PWM duty cycle (local zone) or publishes it as a command (other zones)."""
     duty = max(0, min(100, duty))
-    
-    if duty != current_duty:
-        pwm.ChangeDutyCycle(duty)
-        current_duty = duty
-    
-    # Log every time as requested
-    log_fan_state(duty)
 
-def control_fan_duty(co2_ppm: float, setpoints: dict, verbose: bool = True):
+    if duty != zone.current_duty:
+        if zone.local:
+            with metrics.time("gpio_write"):
+                pwm.ChangeDutyCycle(duty)
+            metrics.inc("greenhouse_gpio_writes_total")
+        else:
+            publish_actuator_command(zone, "fan", {"duty": duty})
+        zone.current_duty = duty
+
+    # Change detection in log_fan_state keeps this from posting unchanged duty cycles
+    log_fan_state(zone, duty)
+
+def control_fan_duty(zone: Zone, co2_ppm: float, setpoints: dict, verbose: bool = True):
     """Calculates and sets the fan PWM duty cycle based on CO2 level."""
-    global current_duty, last_co2
-    
     # --- Calculation Logic ---
     co2_min = setpoints.get('co2_min_ppm', 500)
     co2_low = setpoints.get('co2_low_ppm', 600)
     co2_high = setpoints.get('co2_high_ppm', 1500)
 
     target_co2 = co2_ppm
-    if current_duty > 0:
+    if zone.current_duty > 0:
         target_co2 += HYSTERESIS
     else:
         target_co2 -= HYSTERESIS
@@ -290,59 +1055,60 @@ def control_fan_duty(co2_ppm: float, setpoints: dict, verbose: bool = True):
         duty = int(30 + 70 * (target_co2 - co2_low) / (co2_high - co2_low))
     else:
         duty = 100
-    
-    set_fan_duty(duty)
-    
+
+    set_fan_duty(zone, duty)
+
     # Logging trend
-    co2_for_trend = last_co2 
-    last_co2 = co2_ppm 
+    co2_for_trend = zone.last_co2
+    zone.last_co2 = co2_ppm
     status = "ON" if duty > 0 else "OFF"
     trend = ""
     if co2_ppm > co2_for_trend + 20:
         trend = " (rising)"
     elif co2_ppm < co2_for_trend - 20:
         trend = " (falling)"
-    
+
     if verbose:
         print(f"      [Fan Status] CO2 {co2_ppm:.0f} ppm{trend} → Fan {status} ({duty:3d}%)")
 
-def control_curtain(lux: float, setpoints: dict, verbose: bool = True):
+def control_curtain(zone: Zone, lux: float, setpoints: dict, verbose: bool = True):
     """Controls the blackout curtain based on light intensity."""
     light_max_lux = setpoints.get('light_max_lux', 50000)
-    
+
     target_state = lux > light_max_lux
     status_str = "ON" if target_state else "OFF"
-    
+
     if verbose:
         print(f"      [Curtain Status] Light {lux:.1f} lux (Max: {light_max_lux}) → Curtain {status_str}")
 
-    log_curtain_state(target_state, lux)
-    set_output_state(CURTAIN_PIN, target_state, "Curtain")
+    log_curtain_state(zone, target_state, lux)
+    set_output_state(zone, CURTAIN_PIN, target_state, "Curtain")
 
-def control_irrigation(soil_raw: float, setpoints: dict, verbose: bool = True):
+def control_irrigation(zone: Zone, soil_raw: float, setpoints: dict, verbose: bool = True):
     """Controls the irrigation pump based on calculated soil moisture percentage."""
     soil_min_percent = setpoints.get('soil_min_percent', 30.0)
-    
+
     # Use cached calibration
-    dry = cached_soil_calib.get('dry_adc', 3000)
-    wet = cached_soil_calib.get('wet_adc', 1200)
-    
+    soil_calib = zone.soil_calib
+    dry = soil_calib.get('dry_adc', 3000)
+    wet = soil_calib.get('wet_adc', 1200)
+
     if dry == wet:
         return
 
     percent = ((dry - soil_raw) / (dry - wet)) * 100
     percent = max(0, min(100, percent))
-    
+
     target_state = percent < soil_min_percent
     status_str = "ON" if target_state else "OFF"
 
     if verbose:
         print(f"      [Pump Status] Moisture {percent:.1f}% (Min: {soil_min_percent}%) → Pump {status_str}")
 
-    log_irrigation_state(target_state, percent)
-    set_output_state(PUMP_PIN, target_state, "Pump")
+    log_irrigation_state(zone, target_state, percent)
+    set_output_state(zone, PUMP_PIN, target_state, "Pump")
 
-def control_climate(co2: float, temp: float, hum: float, current_vpd: float, setpoints: dict, verbose: bool = True):
+def control_climate(zone: Zone, co2: float, temp: float, hum: float, current_vpd: float, setpoints: dict, verbose: bool = True):
     """
     【最終精簡版本】VPD/Temperature 優先的整合氣候控制函式。
     優先級: 溫度極限 (安全) > VPD (生理優化) > CO2 (生長優化)
@@ -351,68 +1117,201 @@ def control_climate(co2: float, temp: float, hum: float, current_vpd: float, set
     temp_max = setpoints.get('temp_max_c', 30.0)
     vpd_low = setpoints.get('vpd_target_low', 0.8)
     vpd_high = setpoints.get('vpd_target_high', 1.2)
-    
+
     heater_state = False
     mister_state = False
-    
+
     # 1. 溫度極限緊急覆蓋 (Priority 1: Safety & Survival)
     if temp > temp_max:
         mister_state = True # 霧化輔助降溫
-        set_fan_duty(100) # 強制最大排氣
+        set_fan_duty(zone, 100) # 強制最大排氣
         print(f"      [SAFETY OVERRIDE] Temp ({temp:.1f}°C) is EXTREME HIGH. Mister ON, Fan 100%.")
 
     elif temp < temp_min:
         heater_state = True
-        set_fan_duty(0) # 關閉風扇保留熱量
+        set_fan_duty(zone, 0) # 關閉風扇保留熱量
         print(f"      [SAFETY OVERRIDE] Temp ({temp:.1f}°C) is EXTREME LOW. Heater ON, Fan OFF.")
 
     # 2. VPD 偏離目標範圍決策 (Priority 2: Physiological Optimization)
     # A. VPD 過高 (乾燥)：需要加濕
     elif current_vpd > vpd_high:
         mister_state = True
-        set_fan_duty(0) 
+        set_fan_duty(zone, 0)
         print(f"      [VPD Override] VPD ({current_vpd:.2f} kPa) is HIGH (Dry). Mister ON, Fan OFF.")
 
     # B. VPD 過低 (潮濕)：需要除濕
     elif current_vpd < vpd_low:
-        set_fan_duty(100)
+        set_fan_duty(zone, 100)
         print(f"      [VPD Override] VPD ({current_vpd:.2f} kPa) is LOW (Wet). Fan 100% (Dehumidify).")
 
     # 3. CO2 標準控制 (Priority 3: Growth Optimization)
     else:
         if verbose:
             print("      [Climate Stable] Executing CO2 Control.")
-        control_fan_duty(co2, setpoints, verbose)
+        control_fan_duty(zone, co2, setpoints, verbose)
 
     # Apply and Log States
-    set_output_state(HEATER_PIN, heater_state, "Heater")
-    
-    global last_heater_state
-    # Log if state changed OR if verbose (periodic heartbeat)
-    if last_heater_state != heater_state or verbose:
-        log_heater_state(heater_state, temp)
-        last_heater_state = heater_state
-    
-    set_output_state(MISTER_PIN, mister_state, "Mister")
-    
-    global last_mister_state
-    # Log if state changed OR if verbose (periodic heartbeat)
-    if last_mister_state != mister_state or verbose:
-        log_mister_state(mister_state, current_vpd)
-        last_mister_state = mister_state
+    set_output_state(zone, HEATER_PIN, heater_state, "Heater")
+    log_heater_state(zone, heater_state, temp)
+
+    set_output_state(zone, MISTER_PIN, mister_state, "Mister")
+    log_mister_state(zone, mister_state, current_vpd)
+
+
+# ==================== Sensor State & Control Loop ====================
+
+class SensorState:
+    """
+    Latest-value store shared between MQTT ingestion and the control loop.
+    Each channel ("air", "soil", "light") keeps its freshest values, arrival time and a sequence number.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> (values, monotonic arrival time, seq)
+
+    def update(self, channel: str, values: dict):
+        with self.lock:
+            seq = self.channels[channel][2] + 1 if channel in self.channels else 1
+            self.channels[channel] = (values, time.monotonic(), seq)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.channels)
+
+def control_tick(zone: Zone):
+    """
+    Evaluates the zone's control chain once using its freshest readings.
+    A channel is evaluated only if it received new data since the previous tick,
+    so a fast-publishing sensor costs at most one evaluation per tick.
+    """
+    now = time.monotonic()
+    setpoints = zone.setpoints
+    for channel, (values, arrived, seq) in zone.sensor_state.snapshot().items():
+        if zone.last_control_seq.get(channel) == seq or now - arrived > SENSOR_STALE_AFTER:
+            continue
+        zone.last_control_seq[channel] = seq
+
+        verbose = False
+        if channel not in zone.last_control_log_time or now - zone.last_control_log_time[channel] > LOG_INTERVAL:
+            verbose = True
+            zone.last_control_log_time[channel] = now
+
+        if channel == "air":
+            current_vpd = calculate_vpd(values["temp"], values["hum"])
+            if current_vpd is not None:
+                if verbose:
+                    print(f"      [VPD] Zone '{zone.name}' calculated VPD: {current_vpd:.2f} kPa")
+                with metrics.time("control_climate"):
+                    control_climate(zone, values["co2"], values["temp"], values["hum"], current_vpd, setpoints, verbose)
+        elif channel == "soil":
+            with metrics.time("control_irrigation"):
+                control_irrigation(zone, values["soil_raw"], setpoints, verbose)
+        elif channel == "light":
+            with metrics.time("control_curtain"):
+                control_curtain(zone, values["lux"], setpoints, verbose)
+
+def zone_worker(zone: Zone):
+    """
+    Per-zone worker: ingests the zone's queued messages and runs control_tick at a
+    fixed rate of one tick per CONTROL_INTERVAL, independent of message arrival.
+    """
+    next_tick = time.monotonic()
+    while not control_stop_event.is_set():
+        try:
+            topic, sensor_type, raw = zone.queue.get(timeout=max(0.0, next_tick - time.monotonic()))
+            ingest_sensor_message(zone, topic, sensor_type, raw)
+        except queue.Empty:
+            pass
+        except Exception as e:
+            metrics.inc("greenhouse_errors_total", kind="ingest")
+            print(f"[Zone Error] Ingestion failed for zone '{zone.name}': {e}")
+
+        now = time.monotonic()
+        if now < next_tick:
+            continue
+        try:
+            control_tick(zone)
+        except Exception as e:
+            metrics.inc("greenhouse_errors_total", kind="control")
+            print(f"[Control Error] Control tick failed for zone '{zone.name}': {e}")
+
+        next_tick += CONTROL_INTERVAL
+        if next_tick < now:
+            # Tick overran: skip missed ticks instead of bursting to catch up
+            next_tick = now + CONTROL_INTERVAL
+
+
+# ==================== Sensor Payload Decoding ====================
+
+# Compact binary frames from the ESP32 nodes: a version byte followed by little-endian
+# scaled integers, one layout per sensor type (last topic segment): (struct format, [(key, scale), ...])
+BINARY_FRAME_VERSION = 0x01
+BINARY_LAYOUTS = {
+    "air_th": (struct.Struct("<BhHHh"), [("temp", 0.01), ("humidity", 0.01), ("co2", 1), ("rssi", 1)]),
+    "soil": (struct.Struct("<BHh"), [("soil_raw", 1), ("rssi", 1)]),
+    "light": (struct.Struct("<BIh"), [("lux", 0.01), ("rssi", 1)]),
+}
+
+def decode_sensor_payload(topic: str, raw: bytes) -> dict | None:
+    """
+    Decodes a sensor payload, auto-detecting the encoding from its first byte:
+    JSON object ('{'), MessagePack map (0x80-0x8f, 0xde, 0xdf) or a versioned binary frame.
+    Returns None if the payload cannot be decoded.
+    """
+    if not raw:
+        return None
+    first = raw.lstrip()[:1]
+
+    if first == b"{":
+        try:
+            data = json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    lead = raw[0]
+    if 0x80 <= lead <= 0x8f or lead in (0xde, 0xdf):
+        if msgpack is None:
+            print("    Warning: MessagePack payload received but msgpack is not installed.")
+            return None
+        try:
+            data = msgpack.unpackb(raw, raw=False)
+        except Exception:
+            return None
+        return data if isinstance(data, dict) else None
+
+    layout = BINARY_LAYOUTS.get(topic.rsplit("/", 1)[-1])
+    if lead == BINARY_FRAME_VERSION and layout and len(raw) == layout[0].size:
+        fields = layout[0].unpack(raw)[1:]
+        return {key: (value * scale if scale != 1 else value) for (key, scale), value in zip(layout[1], fields)}
+
+    return None
 
 
 # ==================== MQTT Functions ====================
 
+def parse_sensor_topic(topic: str) -> tuple[str, str] | None:
+    """
+    Maps a sensor topic to (zone, sensor type).
+    greenhouse/sensor/<type> belongs to DEFAULT_ZONE; greenhouse/<zone>/sensor/<type> to <zone>.
+    """
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == "greenhouse" and parts[1] == "sensor":
+        return DEFAULT_ZONE, parts[2]
+    if len(parts) >= 4 and parts[0] == "greenhouse" and parts[2] == "sensor":
+        return parts[1], parts[3]
+    return None
+
 def on_connect(client, userdata, flags, reasoncode, properties):
     if reasoncode == 0:
         print("[MQTT] Connected successfully. Subscribing topics...")
-        for topic in TOPICS:
+        for topic in TOPICS + CONFIG_TOPICS + [ZONE_CONFIG_TOPIC]:
             client.subscribe(topic)
             print(f"    Subscribed: {topic}")
-        
-        # Fetch initial config on connect
-        fetch_remote_config()
+
+        # Fetch initial config on connect (off the MQTT network thread)
+        refresh_config_in_background()
     else:
         print(f"[MQTT] Connection failed, reasoncode={reasoncode}")
 
@@ -420,91 +1319,121 @@ def on_disconnect(client, userdata, flags, reasoncode, properties):
     print("[MQTT] Disconnected from broker. Will auto-reconnect...")
 
 def on_message(client, userdata, msg):
-    """Main control loop: reads sensor data, uploads it, and executes control logic."""
-    global last_log_time, received_topics_for_separator
-    payload = msg.payload.decode("utf-8")
+    """Dispatch: routes config messages, and hands sensor messages to their zone's worker."""
     topic = msg.topic
-    ts_str = datetime.now().strftime("%H:%M:%S")
-    now = datetime.now()
+    parts = topic.split("/")
 
-    device_name = {
-        "greenhouse/sensor/air_th": "ESP32 Air_TH Sensor",
-        "greenhouse/sensor/soil": "ESP32 Soil Sensor",
-        "greenhouse/sensor/light": "ESP32 Light Sensor"
-    }.get(topic, "Unknown Device")
+    if topic in CONFIG_TOPICS or (len(parts) == 4 and parts[2] == "config"):
+        try:
+            data = json.loads(msg.payload)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print(f"[MQTT Warning] Non-JSON config payload on {topic}: {msg.payload!r}")
+            return
+        # paho re-raises callback exceptions, so anything but an object must stop here
+        if not isinstance(data, dict):
+            print(f"[MQTT Warning] Config payload on {topic} is not a JSON object: {msg.payload!r}")
+            return
+        handle_config_message(topic, data)
+        return
+
+    metrics.inc("greenhouse_messages_total", topic=topic)
+    parsed = parse_sensor_topic(topic)
+    if parsed is None:
+        return
+    zone = get_zone(parsed[0])
+    if zone is None:
+        return
+
+    item = (topic, parsed[1], msg.payload)
+    try:
+        zone.queue.put_nowait(item)
+    except queue.Full:
+        # Zone worker is falling behind: keep the newest readings
+        try:
+            zone.queue.get_nowait()
+            zone.dropped += 1
+            metrics.inc("greenhouse_zone_queue_dropped_total", zone=zone.name)
+            if zone.dropped % 100 == 1:
+                print(f"[Zone Warning] Queue for zone '{zone.name}' full, dropped {zone.dropped} readings so far.")
+        except queue.Empty:
+            pass
+        try:
+            zone.queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+def ingest_sensor_message(zone: Zone, topic: str, sensor_type: str, raw: bytes):
+    """Ingestion (zone worker): decodes sensor data, queues it for upload and updates the zone's latest readings."""
+    now = time.monotonic()
 
     verbose = False
-    if topic not in last_log_time or (now - last_log_time[topic]).total_seconds() > LOG_INTERVAL:
+    if topic not in zone.last_log_time or now - zone.last_log_time[topic] > LOG_INTERVAL:
         verbose = True
-        last_log_time[topic] = now
+        zone.last_log_time[topic] = now
 
     if verbose:
+        ts_str = datetime.now().strftime("%H:%M:%S")
+        device_name = DEVICE_NAMES.get(sensor_type, "Unknown Device")
         print(f"\n[{ts_str}] Data from {device_name} ({topic}):")
-    
-    try:
-        data = json.loads(payload)
-    except json.JSONDecodeError:
-        print(f"    Warning: Non-JSON payload: {payload}")
+
+    with metrics.time("decode"):
+        data = decode_sensor_payload(topic, raw)
+    if data is None:
+        metrics.inc("greenhouse_errors_total", kind="decode")
+        print(f"    Warning: Undecodable payload: {raw!r}")
         return
 
     if verbose:
         for key, value in data.items():
             print(f"    {key:>8}: {value}")
-    
-    # 1. Upload Data to Remote API
-    upload_sensor_data(topic, data)
 
-    # 2. Execute Control Logic (using cached setpoints)
-    if topic == "greenhouse/sensor/air_th":
+    # 1. Queue Data for Upload to Remote API (sent in batches by the upload worker)
+    with metrics.time("upload_sensor_data"):
+        upload_sensor_data(topic, data)
+
+    # 2. Update Latest Readings (control logic runs on the zone's fixed-rate tick)
+    if sensor_type == "air_th":
         try:
             raw_temp = data.get("temp")
             raw_hum = data.get("hum") or data.get("humidity")
             raw_co2 = data.get("co2")
 
             if raw_temp is not None and raw_hum is not None and raw_co2 is not None:
-                temp = float(raw_temp)
-                hum = float(raw_hum)
-                co2 = float(raw_co2)
-                
-                current_vpd = calculate_vpd(temp, hum)
-                if current_vpd is not None:
-                    if verbose:
-                        print(f"      [VPD] Calculated VPD: {current_vpd:.2f} kPa")
-                    control_climate(co2, temp, hum, current_vpd, cached_setpoints, verbose)
+                zone.sensor_state.update("air", {"temp": float(raw_temp), "hum": float(raw_hum), "co2": float(raw_co2)})
         except (ValueError, TypeError) as e:
             print(f"    Error processing air data: {e}")
-            
-    elif topic == "greenhouse/sensor/soil":
+
+    elif sensor_type == "soil":
         val = data.get("soil_raw") or data.get("value")
         if val is not None:
             try:
-                control_irrigation(float(val), cached_setpoints, verbose)
+                zone.sensor_state.update("soil", {"soil_raw": float(val)})
             except (ValueError, TypeError):
                 pass
-            
-    elif topic == "greenhouse/sensor/light":
+
+    elif sensor_type == "light":
         raw_lux = data.get("lux")
         if raw_lux is not None:
             try:
-                control_curtain(float(raw_lux), cached_setpoints, verbose)
+                zone.sensor_state.update("light", {"lux": float(raw_lux)})
             except (ValueError, TypeError):
                 pass
 
-    # Print separator if all topics have been logged in this cycle
+    # Print separator if all sensor types of this zone have been logged in this cycle
     if verbose:
-        received_topics_for_separator.add(topic)
-        if EXPECTED_TOPICS.issubset(received_topics_for_separator):
+        zone.received_types.add(sensor_type)
+        if EXPECTED_SENSOR_TYPES.issubset(zone.received_types):
             print("-" * 60)
-            received_topics_for_separator.clear()
+            zone.received_types.clear()
 
 # ==================== Main Execution ====================
 
 async def config_refresh_loop():
-    """Background task to refresh configuration periodically."""
+    """Background task polling the backend's configuration every CONFIG_REFRESH_INTERVAL seconds (conditional GETs)."""
     while True:
-        await asyncio.sleep(60) # Refresh every 60 seconds
-        print("[System] Refreshing configuration from remote API...")
-        fetch_remote_config()
+        await asyncio.sleep(CONFIG_REFRESH_INTERVAL)
+        # Blocking HTTP runs in a worker thread so the event loop is never stalled
+        await asyncio.to_thread(fetch_remote_config)
 
 async def main_async():
     global mqtt_client 
@@ -517,6 +1446,10 @@ async def main_async():
     
     print(f"[MQTT] Connecting to {BROKER}:{PORT} ...")
     try:
+        start_metrics_server()
+        init_spool()
+        start_upload_worker()
+        get_zone(DEFAULT_ZONE)
         client.connect(BROKER, PORT, keepalive=60)
         client.loop_start() 
         mqtt_client = client
@@ -530,7 +1463,11 @@ async def main_async():
         print("[System] Shutting down services...")
         client.loop_stop()
         client.disconnect()
-        set_fan_duty(0)
+        stop_zone_workers()
+        set_fan_duty(get_zone(DEFAULT_ZONE), 0)  # Before the upload worker's final flush, so the event is sent
+        stop_upload_worker()
+        close_spool()
+        api.close()
         pwm.stop()
         try:
             GPIO.output(FAN_INA, GPIO.LOW)
@@ -548,7 +1485,7 @@ if __name__ == "__main__":
         asyncio.run(main_async())
     except KeyboardInterrupt:
         print("Program interrupted by user. Performing forced cleanup...")
-        set_fan_duty(0)
+        pwm.ChangeDutyCycle(0)
         pwm.stop()
         try:
             GPIO.output(FAN_INA, GPIO.LOW)
@@ -1,15 +1,45 @@
 #!/usr/bin/env python3
+import itertools
 import json
+import math
+import queue
 import sqlite3
+import struct
 import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
 from datetime import datetime, timedelta
 import uvicorn
-from fastapi import FastAPI, HTTPException, Path
+from fastapi import FastAPI, HTTPException, Path, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES
+from starlette.datastructures import Headers, MutableHeaders
 import paho.mqtt.client as mqtt
+try:
+    import msgpack  # Optional: MessagePack sensor payloads
+except ImportError:
+    msgpack = None
+try:
+    import numpy as np  # Optional: vectorized LTTB downsampling of history
+except ImportError:
+    np = None
+try:
+    import orjson  # Optional: faster JSON encoding of API responses
+except ImportError:
+    orjson = None
+try:
+    import brotli  # Optional: brotli response compression (gzip is always available)
+except ImportError:
+    brotli = None
 import RPi.GPIO as GPIO
 # 引入 Pydantic 進行數據驗證
 from pydantic import BaseModel, Field
+import export_data  # Bulk export encoders, shared with the export_data.py CLI
 
 # ==================== Configuration & Globals ====================
 BROKER = "127.0.0.1"
@@ -23,6 +53,8 @@ TOPICS = [
     "greenhouse/sensor/soil",
     "greenhouse/sensor/light"
 ]
+# Device-buffered readings flushed after a Wi-Fi or broker outage (greenhouse/sensor/<sensor>/batch)
+BATCH_TOPIC = "greenhouse/sensor/+/batch"
 
 # Fan PWM pin (BCM numbering)
 FAN_INA = 17
@@ -36,6 +68,58 @@ CURTAIN_PIN = 27  # Blackout Curtain (Shading)
 HEATER_PIN = 22   # Heating System
 PUMP_PIN = 23     # Irrigation Pump
 MISTER_PIN = 26   # NEW: Misting/Fogging System
+ACTUATOR_PINS = {"curtain": CURTAIN_PIN, "heater": HEATER_PIN, "pump": PUMP_PIN, "mister": MISTER_PIN}
+
+# --- Control Loop ---
+CONTROL_INTERVAL = 1.0       # Seconds between control ticks (1 Hz), independent of MQTT message rate
+SENSOR_STALE_AFTER = 120.0   # Readings older than this are not used for control (seconds)
+
+# --- DB Writer: one thread owns the write connection and group-commits queued rows ---
+DB_WRITE_QUEUE_MAX = 20000   # Pending statements before the oldest are dropped
+DB_COMMIT_MAX_ROWS = 500     # Commit once this many rows are pending...
+DB_COMMIT_INTERVAL = 1.0     # ...or once the oldest pending row has waited this long (seconds)
+DB_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",     # Readers (API routes) never block behind the writer
+    "PRAGMA synchronous=NORMAL",   # fsync at checkpoints instead of on every commit (safe with WAL)
+    "PRAGMA cache_size=-8000",     # 8 MB page cache
+    "PRAGMA temp_store=MEMORY",
+]
+
+# --- Batch Ingest ---
+BATCH_MAX_READINGS = 5000     # Samples accepted per batch; larger buffers are flushed in several batches
+BATCH_MAX_BYTES = 1024 * 1024  # Larger batch payloads are refused before they are decoded
+BATCH_MAX_AGE_HOURS = 7 * 24  # Older device timestamps are rejected (unset clock); (device, seq) is remembered as long
+BATCH_MAX_CLOCK_SKEW = 300.0  # Seconds a device timestamp may lie in the future
+
+# --- API Response Compression ---
+COMPRESS_MIN_BYTES = 1024       # Smaller bodies are sent as is
+COMPRESS_GZIP_LEVEL = 5         # Most of level 9's ratio for a fraction of the CPU
+COMPRESS_BROTLI_QUALITY = 4     # Fast setting that still beats gzip on JSON
+COMPRESS_EXCLUDE_PATHS = ("/api/v1/stream",)  # Live SSE events must not wait in a compressor
+COMPRESS_EXCLUDE_TYPES = ("application/vnd.apache.parquet", "application/vnd.apache.arrow.stream")  # Binary exports: not worth the CPU
+
+# --- API Reads: blocking SQLite work of the async routes runs on a bounded thread pool ---
+DB_READ_WORKERS = 4          # Queries served in parallel; each worker keeps its own read-only connection
+
+# --- Storage Partitions & Retention ---
+RETENTION_MONTHS = 12              # Raw readings, fan logs and minute rollups kept for this many months (0 = forever)
+RETENTION_CHECK_INTERVAL = 3600.0  # Seconds between retention passes (run by the DB writer)
+
+# --- History Rollups ---
+ROLLUP_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}  # name -> bucket width (seconds), finest first
+HISTORY_TARGET_POINTS = 200  # Auto resolution: coarsest rollup that still yields at least this many points
+
+# --- History Paging & Streaming ---
+HISTORY_PAGE_MAX = 10000     # Largest page (limit=) a history request may ask for
+HISTORY_STREAM_CHUNK = 1000  # Encoded pieces joined into each chunk of a streamed response
+HISTORY_STREAM_FORMATS = {"ndjson": "application/x-ndjson", "json": "application/json"}
+HISTORY_SHAPES = ("rows", "columns")  # List of point objects, or one array per field
+LTTB_MIN_POINTS = 3          # max_points must keep at least the first, one bucket and the last point
+
+# --- Live Updates (Server-Sent Events) ---
+LIVE_MAX_CLIENTS = 32        # Concurrent /api/v1/stream subscribers
+LIVE_CLIENT_BUFFER = 256     # Pending (kind, name) entries per client before the oldest is dropped
+LIVE_KEEPALIVE = 15.0        # Seconds between keep-alive comments on an idle stream
 
 # --- Internal Keys ---
 ACTIVE_PROFILE_KEY = "active_profile_name"
@@ -44,10 +128,18 @@ SOIL_CALIB_KEY = "soil_calib"
 
 # Topic for sending configuration command to ESP32
 CONFIG_TOPIC = "greenhouse/config/soil" 
+# Retained topic carrying the active profile, so other controllers apply profile switches immediately
+PROFILE_TOPIC = "greenhouse/config/profile"
 
 # Global reference for the MQTT client
 mqtt_client = None 
 
+# DB writer state
+db_write_queue = queue.Queue(maxsize=DB_WRITE_QUEUE_MAX)
+db_writer_stop_event = threading.Event()
+db_writer_thread = None
+db_write_dropped = 0
+
 # Global Fan State
 current_duty = 0
 last_co2 = 0 
@@ -99,6 +191,126 @@ for pin in [CURTAIN_PIN, HEATER_PIN, PUMP_PIN, MISTER_PIN]: # 加入 MISTER_PIN
     GPIO.setup(pin, GPIO.OUT)
     GPIO.output(pin, GPIO.LOW) # Ensure all systems are OFF initially
 
+# ==================== Metrics ====================
+
+class Metrics:
+    """
+    Minimal in-process metrics registry rendered in Prometheus text format.
+    Counters and latency histograms are keyed by name and labels; gauges are sampled at scrape time.
+    """
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self.gauges = {}      # name -> callable returning a number or {labels: number}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        # Label values are stored as strings: render() sorts the keys, and 200 vs "error" would not compare
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def time(self, stage: str):
+        """Times a hot-path stage into greenhouse_stage_seconds{stage=...}."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("greenhouse_stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for k, v in labels:
+            escaped = str(v).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{k}="{escaped}"')
+        return "{" + ",".join(parts) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+
+        def header(name, default_kind):
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name in sorted({k[0] for k in counters}):
+            header(name, "counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+
+        for name in sorted({k[0] for k in histograms}):
+            header(name, "histogram")
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                for bound, count in zip(self.BUCKETS, hist):
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {hist[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            header(name, "gauge")
+            if isinstance(value, dict):
+                for labels, v in sorted(value.items()):
+                    lines.append(f"{name}{self._labels(labels)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("greenhouse_stage_seconds", "histogram", "Latency of hot-path stages in seconds.")
+metrics.describe("greenhouse_messages_total", "counter", "MQTT messages received per topic.")
+metrics.describe("greenhouse_errors_total", "counter", "Errors by kind.")
+metrics.describe("greenhouse_gpio_writes_total", "counter", "GPIO output and PWM writes.")
+metrics.describe("greenhouse_db_commits_total", "counter", "SQLite commits by database.")
+metrics.describe("greenhouse_api_requests_total", "counter", "API requests served by route and status.")
+metrics.describe("greenhouse_db_rows_dropped_total", "counter", "Queued DB writes dropped because the writer fell behind.")
+metrics.describe("greenhouse_queue_depth", "gauge", "Items waiting in internal queues.")
+metrics.gauge("greenhouse_queue_depth", lambda: {(("queue", "db_write"),): db_write_queue.qsize()})
+metrics.describe("greenhouse_live_clients", "gauge", "Connected live update (SSE) clients.")
+metrics.gauge("greenhouse_live_clients", lambda: len(live_hub.subscribers))
+metrics.describe("greenhouse_batch_samples_total", "counter", "Batch ingest samples by result (stored, duplicate, rejected).")
+metrics.describe("greenhouse_live_updates_dropped_total", "counter", "Live updates dropped because a client's buffer was full.")
 
 # ==================== Helper Functions: Math & Configuration ====================
 
@@ -127,26 +339,25 @@ def calculate_vpd(T: float, RH: float) -> float | None:
         print(f"[VPD Error] Calculation failed: {e}")
         return None
 
-def get_active_setpoints() -> dict:
-    """Loads and returns the setpoints of the currently active plant profile (with default fallback)."""
-    active_name_config = load_config_from_db(ACTIVE_PROFILE_KEY)
-    active_name = active_name_config.get('name', DEFAULT_PROFILE_NAME) if active_name_config else DEFAULT_PROFILE_NAME
-    setpoints_config = load_config_from_db(f"profile_{active_name}")
-    
-    if setpoints_config:
-        try:
-            # 確保使用最新的 Pydantic 模型進行驗證和預設值填充
-            return ClimateSetpoints(**setpoints_config).model_dump()
-        except Exception:
-            # 如果舊的配置結構不兼容，則返回預設值
-            print("[CONFIG WARNING] Active profile failed Pydantic validation. Falling back to default.")
-            setpoints_config = None
+def get_active_setpoints() -> MappingProxyType:
+    """
+    Returns the setpoints of the currently active plant profile (with default fallback).
+    Served from config_cache as a read-only mapping; use dict(...) before serializing.
+    """
+    active_name = config_cache.active_name()
+    profiles = config_cache.profiles()
+    setpoints = profiles.get(active_name)
+    if setpoints is not None:
+        return setpoints
+    if active_name in profiles:
+        # 如果舊的配置結構不兼容，則返回預設值
+        print("[CONFIG WARNING] Active profile failed Pydantic validation. Falling back to default.")
     
     # Fallback to default
     default_setpoints = ClimateSetpoints().model_dump()
     save_config_to_db(f"profile_{DEFAULT_PROFILE_NAME}", default_setpoints)
     save_config_to_db(ACTIVE_PROFILE_KEY, {'name': DEFAULT_PROFILE_NAME})
-    return default_setpoints
+    return MappingProxyType(default_setpoints)
 
 
 # ==================== GPIO Control Functions with Interlocks ====================
@@ -156,9 +367,12 @@ def set_output_state(pin: int, state: bool, system_name: str):
     target_state = GPIO.HIGH if state else GPIO.LOW
     
     if GPIO.input(pin) != target_state:
-        GPIO.output(pin, target_state)
+        with metrics.time("gpio_write"):
+            GPIO.output(pin, target_state)
+        metrics.inc("greenhouse_gpio_writes_total")
         status = "ON" if state else "OFF"
         print(f"      [{system_name}] Switched {status}")
+        live_hub.publish("actuators", {ACTUATOR_NAMES[pin]: {"status": status, "timestamp": datetime.now().isoformat()}})
 
 
 def control_curtain(lux: float, setpoints: dict):
@@ -175,7 +389,7 @@ def control_irrigation(soil_raw: float, setpoints: dict):
     """Controls the irrigation pump based on calculated soil moisture percentage."""
     soil_min_percent = setpoints['soil_min_percent']
 
-    config = load_config_from_db(SOIL_CALIB_KEY)
+    config = config_cache.soil_calib()
     
     if not config:
         print("      [System Warning] No soil calibration found. Pump control skipped.")
@@ -315,19 +529,7 @@ def log_fan_state(duty_cycle: int):
     """Logs the fan's new duty cycle and ON/OFF status into fan_logs table."""
     ts = datetime.now().isoformat()
     status = "ON" if duty_cycle > 0 else "OFF"
-    
-    try:
-        conn = get_db_connection()
-        conn.execute(
-            "INSERT INTO fan_logs (timestamp, duty_cycle, status) VALUES (?, ?, ?)",
-            (ts, duty_cycle, status)
-        )
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"[DB WRITE ERROR] Fan log failed: {e}") 
-    finally:
-        if conn:
-            conn.close()
+    enqueue_db_write("fan_logs", [(ts, duty_cycle, status)])
 
 def set_fan_duty(duty: int):
     """Sets the fan PWM duty cycle and logs the change if it occurs."""
@@ -335,65 +537,217 @@ def set_fan_duty(duty: int):
     duty = max(0, min(100, duty))
     
     if duty != current_duty:
-        pwm.ChangeDutyCycle(duty)
+        with metrics.time("gpio_write"):
+            pwm.ChangeDutyCycle(duty)
+        metrics.inc("greenhouse_gpio_writes_total")
         log_fan_state(duty)
         current_duty = duty
+        live_hub.publish("actuators", {"fan": {
+            "status": "ON" if duty > 0 else "OFF", "duty_cycle": duty, "timestamp": datetime.now().isoformat()
+        }})
         
 # ----------------------------------------------------------------------------------
 # DB Functions
 # ----------------------------------------------------------------------------------
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+def get_db_connection(check_same_thread: bool = True):
+    conn = sqlite3.connect(DB_NAME, check_same_thread=check_same_thread)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sensor_readings (
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def hours_ago_ms(hours: float) -> int:
+    return int((datetime.now() - timedelta(hours=hours)).timestamp() * 1000)
+
+def ms_to_iso(ts: int) -> str:
+    """Epoch milliseconds -> local ISO-8601 timestamp, the format the API has always returned."""
+    return datetime.fromtimestamp(ts / 1000).isoformat(timespec="microseconds")
+
+def adopt_unpartitioned_tables(conn: sqlite3.Connection):
+    """
+    Keeps the pre-partitioning readings and fan_logs tables as legacy partitions (dropped whole by
+    retention once expired), or drops them now if empty. readings stays while migrate_storage.py
+    still has sensor_readings rows to convert into it.
+    """
+    legacy_pending = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sensor_readings'").fetchone()
+    if not legacy_pending and conn.execute("SELECT 1 FROM readings LIMIT 1").fetchone() is None:
+        conn.execute("DROP TABLE readings")
+    if conn.execute("SELECT 1 FROM fan_logs LIMIT 1").fetchone() is None:
+        conn.execute("DROP TABLE fan_logs")
+
+def drop_empty_legacy_readings(conn: sqlite3.Connection):
+    """Fresh databases have nothing to convert, so the legacy table is dropped right away."""
+    if conn.execute("SELECT 1 FROM sensor_readings LIMIT 1").fetchone() is None:
+        conn.execute("DROP TABLE sensor_readings")
+
+def rebuild_day_rollups(conn: sqlite3.Connection):
+    """Day buckets used to be aligned with each hour's own UTC offset, splitting DST days: rebuilt from the hour rollups."""
+    for (series_id,) in conn.execute("SELECT id FROM series").fetchall():
+        conn.execute("DELETE FROM rollups WHERE resolution = ? AND series_id = ?", (ROLLUP_RESOLUTIONS["day"], series_id))
+        conn.execute(ROLLUP_FROM_ROLLUPS_SQL, {
+            "coarse": ROLLUP_RESOLUTIONS["day"], "fine": ROLLUP_RESOLUTIONS["hour"], "series_id": series_id, "start": 0, "end": 2 ** 62
+        })
+
+# Schema migrations: (version, description, statements), applied in order by init_db.
+# Append new migrations to the end; never edit or reorder one that has shipped.
+MIGRATIONS = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS sensor_readings (
             id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, topic TEXT NOT NULL, value_key TEXT NOT NULL, value REAL
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS fan_logs (
+        )""",
+        """CREATE TABLE IF NOT EXISTS fan_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, duty_cycle INTEGER NOT NULL, status TEXT NOT NULL 
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS config_settings (
+        )""",
+        """CREATE TABLE IF NOT EXISTS config_settings (
             key TEXT PRIMARY KEY, value TEXT NOT NULL 
+        )""",
+    ]),
+    (2, "sensor_readings time-series indexes", [
+        # /history: WHERE value_key = ? AND timestamp > ? ORDER BY timestamp
+        "CREATE INDEX IF NOT EXISTS idx_readings_key_ts ON sensor_readings (value_key, timestamp)",
+        # /latest: newest id per (topic, value_key)
+        "CREATE INDEX IF NOT EXISTS idx_readings_topic_key_id ON sensor_readings (topic, value_key, id)",
+    ]),
+    (3, "fan_logs timestamp index", [
+        "CREATE INDEX IF NOT EXISTS idx_fan_logs_ts ON fan_logs (timestamp)",
+    ]),
+    (4, "compact series/readings layout", [
+        """CREATE TABLE IF NOT EXISTS series (
+            id INTEGER PRIMARY KEY, topic TEXT NOT NULL, value_key TEXT NOT NULL, UNIQUE (topic, value_key)
+        )""",
+        """CREATE TABLE IF NOT EXISTS readings (
+            series_id INTEGER NOT NULL, ts INTEGER NOT NULL, value REAL, PRIMARY KEY (series_id, ts)
+        ) WITHOUT ROWID""",
+        # Existing rows in sensor_readings are converted online by migrate_storage.py
+        drop_empty_legacy_readings,
+    ]),
+    (5, "min/max/avg rollups", [
+        # resolution: bucket width in seconds; bucket: local-time-aligned bucket start (epoch ms)
+        """CREATE TABLE IF NOT EXISTS rollups (
+            resolution INTEGER NOT NULL, series_id INTEGER NOT NULL, bucket INTEGER NOT NULL,
+            min REAL, max REAL, sum REAL, count INTEGER NOT NULL,
+            PRIMARY KEY (resolution, series_id, bucket)
+        ) WITHOUT ROWID""",
+    ]),
+    (6, "monthly partitions for readings and fan_logs", [
+        # New rows go to readings_YYYYMM / fan_logs_YYYYMM, created on demand by the DB writer
+        adopt_unpartitioned_tables,
+    ]),
+    (7, "batch ingest sequence numbers", [
+        # (device, seq) of every stored batch sample, so re-sent batches are skipped; ts: device time (epoch ms)
+        """CREATE TABLE IF NOT EXISTS ingest_seq (
+            device TEXT NOT NULL, seq INTEGER NOT NULL, ts INTEGER NOT NULL, PRIMARY KEY (device, seq)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_ingest_seq_ts ON ingest_seq (ts)",
+    ]),
+    (8, "day rollups aligned to local midnight", [
+        rebuild_day_rollups,
+    ]),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def run_migrations(conn: sqlite3.Connection):
+    """Applies every migration newer than the recorded schema version, each in its own transaction."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TEXT NOT NULL
         )
     """)
-    conn.commit()
-    conn.close()
+    current = get_schema_version(conn)
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"[DB] Applying migration {version}: {description} ...")
+        started = time.monotonic()
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat())
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"[DB] Migration {version} done in {time.monotonic() - started:.1f}s")
+
+def init_db():
+    conn = get_db_connection()
+    conn.isolation_level = None  # Migrations manage their own transactions
+    conn.execute("PRAGMA journal_mode=WAL")  # Persistent: applies to every later connection
+    try:
+        run_migrations(conn)
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sensor_readings'").fetchone():
+            print("[DB] Legacy sensor_readings table found: run migrate_storage.py to convert it to the compact layout.")
+        backfill_rollups(conn)
+        latest_snapshot.load(conn)
+    finally:
+        conn.close()
+
+series_ids = {}  # (topic, value_key) -> series id
+series_lock = threading.Lock()
+
+def get_series_id(topic: str, value_key: str) -> int:
+    """Returns the id of a (topic, value_key) series, creating it on first use."""
+    key = (topic, value_key)
+    series_id = series_ids.get(key)
+    if series_id is not None:
+        return series_id
+    with series_lock:
+        if key not in series_ids:
+            conn = get_db_connection()
+            try:
+                conn.execute("INSERT OR IGNORE INTO series (topic, value_key) VALUES (?, ?)", key)
+                conn.commit()
+                series_ids[key] = conn.execute("SELECT id FROM series WHERE topic = ? AND value_key = ?", key).fetchone()[0]
+            finally:
+                conn.close()
+        return series_ids[key]
+
+def get_series_for_key(conn: sqlite3.Connection, value_key: str) -> list:
+    """Ids of every series (one per topic) recording value_key."""
+    return [row[0] for row in conn.execute("SELECT id FROM series WHERE value_key = ?", (value_key,))]
 
 def save_data_to_db(topic: str, data: dict):
+    """Queues one reading's numeric values for the DB writer (committed in the next group transaction)."""
+    current_ts = now_ms()
+    records = []
+    values = {}
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        current_ts = datetime.now().isoformat()
-        records = []
         for key, value in data.items():
             if key.lower() == 'rssi': continue
             try:
                 numeric_value = float(value) 
-                records.append((current_ts, topic, key, numeric_value))
+                records.append((get_series_id(topic, key), current_ts, numeric_value))
+                values[key] = numeric_value
             except (ValueError, TypeError): pass
-        if records:
-            cursor.executemany("INSERT INTO sensor_readings (timestamp, topic, value_key, value) VALUES (?, ?, ?, ?)", records)
-            conn.commit()
     except sqlite3.Error as e:
+        metrics.inc("greenhouse_errors_total", kind="db_write")
         print(f"[DB WRITE ERROR] Sensor log failed: {e}")
-    finally:
-        if conn: conn.close()
+        return
+    if records:
+        enqueue_db_write("readings", records)
+        latest_snapshot.update(topic, values, current_ts)
+        timestamp = ms_to_iso(current_ts)
+        live_hub.publish("readings", {key.lower(): {"timestamp": timestamp, "value": value} for key, value in values.items()})
 
 def save_config_to_db(key: str, config: dict):
     conn = get_db_connection()
     config_json = json.dumps(config)
     conn.execute("""INSERT OR REPLACE INTO config_settings (key, value) VALUES (?, ?)""", (key, config_json))
     conn.commit()
+    metrics.inc("greenhouse_db_commits_total", db="local")
     conn.close()
+    config_cache.invalidate()
     print(f"[CONFIG] New configuration saved to SQLite for key: {key}")
 
 def load_config_from_db(key: str) -> dict | None:
@@ -427,6 +781,743 @@ def init_default_profiles():
         save_config_to_db(f"profile_{strawberry_name}", strawberry_setpoints)
         print(f"[CONFIG] Initialized default profile: {strawberry_name}")
 
+# ==================== Partitions & Retention ====================
+
+# Raw readings and fan logs live in one table per local calendar month (readings_YYYYMM,
+# fan_logs_YYYYMM), so retention drops whole tables instead of deleting rows.
+# Readings: (series_id, ts epoch ms, value), clustered on (series_id, ts); a repeated
+# (series, ms) keeps the newest value. The unpartitioned tables from before migration 6
+# (readings, fan_logs), if any, act as one legacy partition holding everything older.
+PARTITION_SCHEMAS = {
+    "readings": [
+        """CREATE TABLE IF NOT EXISTS {name} (
+            series_id INTEGER NOT NULL, ts INTEGER NOT NULL, value REAL, PRIMARY KEY (series_id, ts)
+        ) WITHOUT ROWID""",
+    ],
+    "fan_logs": [
+        """CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, duty_cycle INTEGER NOT NULL, status TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_{name}_ts ON {name} (timestamp)",
+    ],
+}
+PARTITION_INSERTS = {
+    "readings": "INSERT OR REPLACE INTO {name} (series_id, ts, value) VALUES (?, ?, ?)",
+    "fan_logs": "INSERT INTO {name} (timestamp, duty_cycle, status) VALUES (?, ?, ?)",
+}
+known_partitions = set()  # Partition tables the writer has created or seen
+
+def month_of_ms(ts: int) -> str:
+    t = time.localtime(ts // 1000)
+    return f"{t.tm_year}{t.tm_mon:02d}"
+
+def month_of_iso(timestamp: str) -> str:
+    return timestamp[:4] + timestamp[5:7]
+
+def row_month(kind: str, row: tuple) -> str:
+    return month_of_ms(row[1]) if kind == "readings" else month_of_iso(row[0])
+
+def ensure_partition(conn: sqlite3.Connection, kind: str, month: str) -> str:
+    name = f"{kind}_{month}"
+    if name not in known_partitions:
+        for ddl in PARTITION_SCHEMAS[kind]:
+            conn.execute(ddl.format(name=name))
+        known_partitions.add(name)
+    return name
+
+def list_partitions(conn: sqlite3.Connection, kind: str, first_month: str = None, last_month: str = None) -> list:
+    """Partition tables of kind overlapping [first_month, last_month], oldest first; the legacy table always comes first."""
+    names = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND (name = ? OR name GLOB ?) ORDER BY name",
+        (kind, f"{kind}_[0-9][0-9][0-9][0-9][0-9][0-9]")
+    )]
+    result = []
+    for name in names:
+        month = name[len(kind) + 1:]
+        if month and ((first_month and month < first_month) or (last_month and month > last_month)):
+            continue
+        result.append(name)
+    return result
+
+def get_latest_readings(conn: sqlite3.Connection, series: list) -> dict:
+    """series id -> newest row (ts, value), searching partitions newest first."""
+    latest = {}
+    pending = set(series)
+    for table in reversed(list_partitions(conn, "readings")):
+        for series_id in list(pending):
+            row = conn.execute(f"SELECT ts, value FROM {table} WHERE series_id = ? ORDER BY ts DESC LIMIT 1", (series_id,)).fetchone()
+            if row:
+                latest[series_id] = row
+                pending.discard(series_id)
+        if not pending:
+            break
+    return latest
+
+def legacy_partition_expired(conn: sqlite3.Connection, kind: str, cutoff_ms: int) -> bool:
+    if kind == "fan_logs":
+        newest = conn.execute("SELECT MAX(timestamp) FROM fan_logs").fetchone()[0]
+        return newest is None or newest < ms_to_iso(cutoff_ms)
+    for (series_id,) in conn.execute("SELECT id FROM series").fetchall():
+        newest = conn.execute("SELECT MAX(ts) FROM readings WHERE series_id = ?", (series_id,)).fetchone()[0]
+        if newest is not None and newest >= cutoff_ms:
+            return False
+    return True
+
+def retention_cutoff() -> tuple[str, int]:
+    """(month, epoch ms) of the first local month kept by retention: the start of the month RETENTION_MONTHS ago."""
+    now = datetime.now()
+    year, month0 = divmod(now.year * 12 + now.month - 1 - RETENTION_MONTHS, 12)
+    return f"{year}{month0 + 1:02d}", int(datetime(year, month0 + 1, 1).timestamp() * 1000)
+
+def apply_retention(conn: sqlite3.Connection):
+    """
+    Drops partitions entirely older than RETENTION_MONTHS and trims minute rollups to the same window.
+    Batch sequence numbers are kept for BATCH_MAX_AGE_HOURS, beyond which re-sent samples are rejected anyway.
+    """
+    conn.execute("DELETE FROM ingest_seq WHERE ts < ?", (hours_ago_ms(BATCH_MAX_AGE_HOURS),))
+    if RETENTION_MONTHS <= 0:
+        return
+    cutoff_month, cutoff_ms = retention_cutoff()
+
+    for kind in PARTITION_SCHEMAS:
+        for name in list_partitions(conn, kind):
+            month = name[len(kind) + 1:]
+            if (month and month < cutoff_month) or (not month and legacy_partition_expired(conn, kind, cutoff_ms)):
+                conn.execute(f"DROP TABLE {name}")
+                known_partitions.discard(name)
+                print(f"[DB] Retention: dropped partition {name}")
+    for (series_id,) in conn.execute("SELECT id FROM series").fetchall():
+        conn.execute(
+            "DELETE FROM rollups WHERE resolution = ? AND series_id = ? AND bucket < ?",
+            (ROLLUP_RESOLUTIONS["minute"], series_id, cutoff_ms)
+        )
+
+# ==================== Rollups ====================
+
+# Hour and day buckets start at local-time boundaries: an hour bucket at the local hour of its rows
+# (off = the row's UTC offset in ms), a day bucket at local midnight, so DST days are 23 or 25 hours long.
+# {source}: UNION ALL of the readings partitions covering the range (one parameterized SELECT each)
+ROLLUP_FROM_READINGS_SQL = """
+    INSERT OR REPLACE INTO rollups (resolution, series_id, bucket, min, max, sum, count)
+    SELECT 60, ?, ts / 60000 * 60000, MIN(value), MAX(value), SUM(value), COUNT(value)
+    FROM ({source})
+    GROUP BY ts / 60000
+"""
+ROLLUP_FROM_ROLLUPS_SQL = """
+    INSERT OR REPLACE INTO rollups (resolution, series_id, bucket, min, max, sum, count)
+    SELECT :coarse, series_id, b, MIN(min), MAX(max), SUM(sum), SUM(count) FROM (
+        SELECT series_id, min, max, sum, count, CASE WHEN :coarse >= 86400
+            THEN CAST(strftime('%s', bucket / 1000, 'unixepoch', 'localtime', 'start of day', 'utc') AS INTEGER) * 1000
+            ELSE (bucket + off) / (:coarse * 1000) * (:coarse * 1000) - off END AS b FROM (
+            SELECT *, (CAST(strftime('%s', bucket / 1000, 'unixepoch', 'localtime') AS INTEGER) - bucket / 1000) * 1000 AS off
+            FROM rollups WHERE resolution = :fine AND series_id = :series_id AND bucket >= :start AND bucket < :end
+        )
+    ) GROUP BY b
+"""
+
+def bucket_floor(ts: int, resolution: int) -> int:
+    """Start (epoch ms) of the local-time-aligned bucket of width resolution seconds containing ts (local midnight for days)."""
+    if resolution >= 86400:
+        day = datetime.fromtimestamp(ts // 1000).replace(hour=0, minute=0, second=0, microsecond=0)
+        return int(day.timestamp()) * 1000
+    off = time.localtime(ts // 1000).tm_gmtoff * 1000
+    return (ts + off) // (resolution * 1000) * (resolution * 1000) - off
+
+def bucket_end(ts: int, resolution: int) -> int:
+    """Start of the bucket after the one containing ts (day buckets are 23-25 hours across DST changes)."""
+    return bucket_floor(bucket_floor(ts, resolution) + resolution * 1500, resolution)
+
+def refresh_rollups(conn: sqlite3.Connection, series_id: int, start_ms: int, end_ms: int):
+    """
+    Recomputes every rollup bucket of one series that overlaps [start_ms, end_ms]:
+    minutes from raw readings, then each coarser resolution from the one below it.
+    Idempotent, so replaced or late readings simply get re-aggregated.
+    """
+    fine = None
+    for resolution in ROLLUP_RESOLUTIONS.values():
+        start = bucket_floor(start_ms, resolution)
+        end = bucket_end(end_ms, resolution)
+        if fine is None:
+            tables = list_partitions(conn, "readings", month_of_ms(start), month_of_ms(end - 1))
+            if tables:
+                source = " UNION ALL ".join(f"SELECT ts, value FROM {table} WHERE series_id = ? AND ts >= ? AND ts < ?" for table in tables)
+                conn.execute(ROLLUP_FROM_READINGS_SQL.format(source=source), (series_id, *((series_id, start, end) * len(tables))))
+        else:
+            conn.execute(ROLLUP_FROM_ROLLUPS_SQL, {"coarse": resolution, "fine": fine, "series_id": series_id, "start": start, "end": end})
+        fine = resolution
+
+def refresh_rollups_for_rows(conn: sqlite3.Connection, rows: list):
+    """Refreshes the buckets touched by a batch of (series_id, ts, value) reading rows."""
+    spans = {}
+    for series_id, ts, _ in rows:
+        low, high = spans.get(series_id, (ts, ts))
+        spans[series_id] = (min(low, ts), max(high, ts))
+    for series_id, (low, high) in spans.items():
+        refresh_rollups(conn, series_id, low, high)
+
+def backfill_rollups(conn: sqlite3.Connection):
+    """
+    Builds rollups for readings older than a series' oldest minute bucket (existing data after
+    the rollups migration, or history converted by migrate_storage.py). Runs at startup, one day per transaction.
+    Readings before the retention cutoff are skipped: retention has trimmed their minute rollups on purpose.
+    """
+    day_ms = 86400 * 1000
+    kept_from = retention_cutoff()[1] if RETENTION_MONTHS > 0 else 0
+    tables = list_partitions(conn, "readings")
+    for (series_id,) in conn.execute("SELECT id FROM series").fetchall():
+        # Separate MIN and MAX queries: each is a single primary-key seek per partition
+        firsts = [conn.execute(f"SELECT MIN(ts) FROM {table} WHERE series_id = ? AND ts >= ?", (series_id, kept_from)).fetchone()[0] for table in tables]
+        lasts = [conn.execute(f"SELECT MAX(ts) FROM {table} WHERE series_id = ?", (series_id,)).fetchone()[0] for table in tables]
+        firsts = [ts for ts in firsts if ts is not None]
+        if not firsts:
+            continue
+        first_ts, last_ts = min(firsts), max(ts for ts in lasts if ts is not None)
+        oldest = conn.execute(
+            "SELECT MIN(bucket) FROM rollups WHERE resolution = ? AND series_id = ?", (ROLLUP_RESOLUTIONS["minute"], series_id)
+        ).fetchone()[0]
+        end = last_ts if oldest is None else oldest - 1
+        if first_ts > end:
+            continue
+        print(f"[DB] Building rollups for series {series_id} ({ms_to_iso(first_ts)} .. {ms_to_iso(end)}) ...")
+        for day_start in range(bucket_floor(first_ts, 86400), end + 1, day_ms):
+            conn.execute("BEGIN")
+            refresh_rollups(conn, series_id, max(day_start, first_ts), min(day_start + day_ms - 1, end))
+            conn.execute("COMMIT")
+
+# ==================== DB Writer ====================
+
+def enqueue_db_write(kind: str, rows: list):
+    """
+    Hands rows to the DB writer thread. If the writer is not running (startup, shutdown, tools)
+    the rows are written synchronously instead. When the queue is full the oldest entry is dropped.
+    """
+    global db_write_dropped
+    if db_writer_thread is None or not db_writer_thread.is_alive():
+        write_rows_now(kind, rows)
+        return
+    item = (kind, rows)
+    try:
+        db_write_queue.put_nowait(item)
+    except queue.Full:
+        try:
+            db_write_queue.get_nowait()
+            db_write_dropped += 1
+            metrics.inc("greenhouse_db_rows_dropped_total")
+        except queue.Empty:
+            pass
+        try:
+            db_write_queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+def write_rows_now(kind: str, rows: list):
+    """Writes rows on a short-lived connection (fallback when the writer thread is not running)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        apply_db_write(conn, kind, rows)
+        conn.commit()
+        metrics.inc("greenhouse_db_commits_total", db="local")
+    except sqlite3.Error as e:
+        known_partitions.clear()  # A rolled-back CREATE TABLE must be re-run
+        metrics.inc("greenhouse_errors_total", kind="db_write")
+        print(f"[DB WRITE ERROR] Write failed: {e}")
+    finally:
+        if conn: conn.close()
+
+def apply_db_write(conn: sqlite3.Connection, kind: str, rows: list):
+    """
+    Inserts rows of a partitioned table kind ("readings" or "fan_logs") into their monthly partitions,
+    keeping derived tables (rollups) in the same transaction. kind "batch" stores batch ingest samples.
+    """
+    if kind == "batch":
+        # Like live readings, stored samples reach the snapshot before the group commit
+        publish_batch_latest(store_sensor_batch(conn, rows))
+        return
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row_month(kind, row), []).append(row)
+    for month, month_rows in by_month.items():
+        conn.executemany(PARTITION_INSERTS[kind].format(name=ensure_partition(conn, kind, month)), month_rows)
+    if kind == "readings":
+        refresh_rollups_for_rows(conn, rows)
+
+def commit_db_batch(conn: sqlite3.Connection, batch: list):
+    """Writes a batch of (kind, rows) entries in one transaction, grouping rows per kind."""
+    grouped = {}
+    for kind, rows in batch:
+        grouped.setdefault(kind, []).extend(rows)
+    try:
+        with metrics.time("db_commit"):
+            with conn:
+                for kind, rows in grouped.items():
+                    apply_db_write(conn, kind, rows)
+        metrics.inc("greenhouse_db_commits_total", db="local")
+    except sqlite3.Error as e:
+        known_partitions.clear()  # A rolled-back CREATE TABLE must be re-run
+        metrics.inc("greenhouse_errors_total", kind="db_write")
+        print(f"[DB WRITE ERROR] Group commit of {len(batch)} entries failed: {e}")
+
+def db_writer():
+    """
+    Single writer thread: owns one long-lived connection and drains db_write_queue.
+    A group transaction is committed when DB_COMMIT_MAX_ROWS rows are pending or when
+    the oldest pending row has waited DB_COMMIT_INTERVAL seconds, whichever comes first.
+    """
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+
+    batch = []
+    pending_rows = 0
+    deadline = None
+    next_retention = time.monotonic()
+    while True:
+        if db_writer_stop_event.is_set() and db_write_queue.empty():
+            break
+
+        if time.monotonic() >= next_retention:
+            next_retention = time.monotonic() + RETENTION_CHECK_INTERVAL
+            try:
+                with conn:
+                    apply_retention(conn)
+            except sqlite3.Error as e:
+                metrics.inc("greenhouse_errors_total", kind="retention")
+                print(f"[DB WRITE ERROR] Retention pass failed: {e}")
+
+        timeout = DB_COMMIT_INTERVAL if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = db_write_queue.get(timeout=min(timeout, 1.0))
+            if not batch:
+                deadline = time.monotonic() + DB_COMMIT_INTERVAL
+            batch.append(item)
+            pending_rows += len(item[1])
+        except queue.Empty:
+            pass
+
+        if batch and (pending_rows >= DB_COMMIT_MAX_ROWS or time.monotonic() >= deadline):
+            commit_db_batch(conn, batch)
+            batch = []
+            pending_rows = 0
+            deadline = None
+
+    if batch:
+        commit_db_batch(conn, batch)
+    conn.close()
+
+def start_db_writer():
+    """Starts the DB writer thread."""
+    global db_writer_thread
+    db_writer_stop_event.clear()
+    db_writer_thread = threading.Thread(target=db_writer, name="db_writer", daemon=True)
+    db_writer_thread.start()
+
+def stop_db_writer(timeout: float = 10.0):
+    """Signals the DB writer to commit pending rows and waits for it to exit."""
+    db_writer_stop_event.set()
+    if db_writer_thread is not None:
+        db_writer_thread.join(timeout)
+
+# ==================== API Read Pool ====================
+
+db_read_executor = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db_read")
+db_read_local = threading.local()
+
+def read_connection() -> sqlite3.Connection:
+    """The calling db_read worker's connection, opened on first use and kept for the worker's lifetime."""
+    conn = getattr(db_read_local, "conn", None)
+    if conn is None:
+        conn = get_db_connection()
+        conn.execute("PRAGMA query_only=ON")
+        db_read_local.conn = conn
+    return conn
+
+async def run_db(fn, *args):
+    """Runs the blocking fn(*args) on the DB read pool, so a slow query never stalls the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(db_read_executor, fn, *args)
+
+
+# ==================== Config Cache ====================
+
+class ConfigCache:
+    """
+    Process-wide cache of config_settings: active profile name, validated profiles and soil calibration.
+    Profiles and calibration are read-only mappings, so callers can share them without copying.
+    save_config_to_db invalidates the cache; the next read reloads the whole table with one query.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.snapshot = None  # (active_name, {profile name: setpoints or None}, soil_calib or None)
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.snapshot = None
+
+    def _get(self) -> tuple:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            generation = self.generation
+        snapshot = self._load()
+        with self.lock:
+            # A write during the load makes this snapshot stale: serve it once, but don't keep it
+            if self.generation == generation:
+                self.snapshot = snapshot
+        return snapshot
+
+    @staticmethod
+    def _load() -> tuple:
+        conn = get_db_connection()
+        rows = conn.execute("SELECT key, value FROM config_settings").fetchall()
+        conn.close()
+
+        active_name, profiles, soil_calib = DEFAULT_PROFILE_NAME, {}, None
+        for row in rows:
+            key = row['key']
+            try:
+                value = json.loads(row['value'])
+            except json.JSONDecodeError:
+                value = None
+            if key == ACTIVE_PROFILE_KEY:
+                if isinstance(value, dict):
+                    active_name = value.get('name', DEFAULT_PROFILE_NAME)
+            elif key == SOIL_CALIB_KEY:
+                if isinstance(value, dict):
+                    soil_calib = MappingProxyType(value)
+            elif key.startswith("profile_"):
+                # 確保使用最新的 Pydantic 模型進行驗證和預設值填充; None marks an invalid profile
+                try:
+                    profiles[key[len("profile_"):]] = MappingProxyType(ClimateSetpoints(**value).model_dump())
+                except Exception:
+                    profiles[key[len("profile_"):]] = None
+        return active_name, profiles, soil_calib
+
+    def active_name(self) -> str:
+        return self._get()[0]
+
+    def profiles(self) -> dict:
+        """Profile name -> read-only setpoints (None if the stored profile is invalid). Do not modify."""
+        return self._get()[1]
+
+    def soil_calib(self) -> MappingProxyType | None:
+        return self._get()[2]
+
+config_cache = ConfigCache()
+
+
+# ==================== Latest Readings Snapshot ====================
+
+class LatestSnapshot:
+    """
+    Newest reading of every (topic, value_key) series, kept in memory by ingestion so the latest routes
+    never query SQLite. version changes with every new reading and, with the boot id, forms their ETag.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.boot = f"{int(time.time()):x}"  # Keeps ETags from a previous run from matching after a restart
+        self.version = 0
+        self.readings = {}  # (topic, value_key) -> (ts, value)
+        self.view = None    # (version, {value_key: {"timestamp", "value"}}) built on the first read after a change
+
+    def load(self, conn: sqlite3.Connection):
+        """Seeds the snapshot from the newest stored reading of each series (startup)."""
+        series = {row['id']: (row['topic'], row['value_key']) for row in conn.execute("SELECT id, topic, value_key FROM series")}
+        latest = get_latest_readings(conn, list(series))
+        now = now_ms()
+        with self.lock:
+            for series_id, row in latest.items():
+                # Clamped like publish_batch_latest, so a future-dated batch sample cannot hide live readings
+                self.readings[series[series_id]] = (min(row['ts'], now), row['value'])
+            self.version += 1
+
+    def update(self, topic: str, values: dict, ts: int) -> list:
+        """Records the values of one sensor message; readings older than the stored ones are ignored. Returns the updated keys."""
+        with self.lock:
+            changed = []
+            for key, value in values.items():
+                current = self.readings.get((topic, key))
+                if current is None or ts >= current[0]:
+                    self.readings[(topic, key)] = (ts, value)
+                    changed.append(key)
+            if changed:
+                self.version += 1
+            return changed
+
+    def get(self) -> tuple[str, dict]:
+        """(ETag, {value_key: {"timestamp", "value"}}) with the newest reading per key, newest first. Do not modify."""
+        with self.lock:
+            if self.view is None or self.view[0] != self.version:
+                newest = {}
+                for (topic, key), (ts, value) in self.readings.items():
+                    key = key.lower()
+                    if key not in newest or ts > newest[key][0]:
+                        newest[key] = (ts, value)
+                ordered = sorted(newest.items(), key=lambda item: item[1][0], reverse=True)
+                self.view = (self.version, {key: {"timestamp": ms_to_iso(ts), "value": value} for key, (ts, value) in ordered})
+            return f'"{self.boot}-{self.view[0]}"', self.view[1]
+
+latest_snapshot = LatestSnapshot()
+
+
+# ==================== Live Updates ====================
+
+ACTUATOR_NAMES = {pin: name for name, pin in ACTUATOR_PINS.items()}
+
+class LiveSubscriber:
+    """One live client: its pending updates, coalesced per (kind, name), and the event that wakes its stream."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.pending = {}  # (kind, name) -> payload, oldest update first; guarded by LiveHub.lock
+
+class LiveHub:
+    """
+    In-process broadcast of new readings and actuator changes to live API clients.
+    Publishers (MQTT and control loop threads) never block: a client that falls behind only gets the newest
+    value per reading/actuator, and beyond LIVE_CLIENT_BUFFER distinct entries its oldest ones are dropped.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self) -> LiveSubscriber:
+        subscriber = LiveSubscriber(asyncio.get_running_loop())
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: LiveSubscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, kind: str, updates: dict):
+        """Queues {name: payload} updates of one kind ("readings" or "actuators") for every subscriber."""
+        if not self.subscribers:
+            return
+        wake = []
+        dropped = 0
+        with self.lock:
+            for subscriber in self.subscribers:
+                pending = subscriber.pending
+                if not pending:
+                    wake.append(subscriber)
+                for name, payload in updates.items():
+                    pending.pop((kind, name), None)  # Re-insert so the buffer stays ordered by last update
+                    pending[(kind, name)] = payload
+                while len(pending) > LIVE_CLIENT_BUFFER:
+                    del pending[next(iter(pending))]
+                    dropped += 1
+        for subscriber in wake:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.wakeup.set)
+            except RuntimeError:
+                pass  # Event loop already closed
+        if dropped:
+            metrics.inc("greenhouse_live_updates_dropped_total", dropped)
+
+    def take(self, subscriber: LiveSubscriber) -> dict:
+        """Removes a subscriber's pending updates, grouped as {kind: {name: payload}}. Call on its event loop."""
+        with self.lock:
+            pending, subscriber.pending = subscriber.pending, {}
+            subscriber.wakeup.clear()
+        delta = {}
+        for (kind, name), payload in pending.items():
+            delta.setdefault(kind, {})[name] = payload
+        return delta
+
+live_hub = LiveHub()
+
+def actuator_states() -> dict:
+    """Current state of every actuator, in the shape of the "actuators" live updates (without timestamps)."""
+    states = {name: {"status": "ON" if GPIO.input(pin) == GPIO.HIGH else "OFF"} for name, pin in ACTUATOR_PINS.items()}
+    states["fan"] = {"status": "ON" if current_duty > 0 else "OFF", "duty_cycle": current_duty}
+    return states
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# ==================== Sensor Payload Decoding ====================
+
+# Compact binary frames from the ESP32 nodes: a version byte followed by little-endian
+# scaled integers, one layout per sensor type (last topic segment): (struct format, [(key, scale), ...])
+BINARY_FRAME_VERSION = 0x01
+BINARY_LAYOUTS = {
+    "air_th": (struct.Struct("<BhHHh"), [("temp", 0.01), ("humidity", 0.01), ("co2", 1), ("rssi", 1)]),
+    "soil": (struct.Struct("<BHh"), [("soil_raw", 1), ("rssi", 1)]),
+    "light": (struct.Struct("<BIh"), [("lux", 0.01), ("rssi", 1)]),
+}
+
+def decode_sensor_payload(topic: str, raw: bytes) -> dict | None:
+    """
+    Decodes a sensor payload, auto-detecting the encoding from its first byte:
+    JSON object ('{'), MessagePack map (0x80-0x8f, 0xde, 0xdf) or a versioned binary frame.
+    Returns None if the payload cannot be decoded.
+    """
+    if not raw:
+        return None
+    first = raw.lstrip()[:1]
+
+    if first == b"{":
+        try:
+            data = json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    lead = raw[0]
+    if 0x80 <= lead <= 0x8f or lead in (0xde, 0xdf):
+        if msgpack is None:
+            print("    Warning: MessagePack payload received but msgpack is not installed.")
+            return None
+        try:
+            data = msgpack.unpackb(raw, raw=False)
+        except Exception:
+            return None
+        return data if isinstance(data, dict) else None
+
+    layout = BINARY_LAYOUTS.get(topic.rsplit("/", 1)[-1])
+    if lead == BINARY_FRAME_VERSION and layout and len(raw) == layout[0].size:
+        fields = layout[0].unpack(raw)[1:]
+        return {key: (value * scale if scale != 1 else value) for (key, scale), value in zip(layout[1], fields)}
+
+    return None
+
+
+# ==================== Batch Ingest ====================
+
+# Nodes buffer samples while Wi-Fi or the broker is down and flush them later, over MQTT
+# (greenhouse/sensor/<sensor>/batch) or HTTP (POST /api/v1/sensor/<sensor>/batch), as a JSON or
+# MessagePack map: {"device": "air-1", "readings": [{"seq": 41, "ts": 1760000000000, "temp": 21.5, ...}]}
+# ts is the device's clock (epoch ms). seq must keep increasing across reboots (or the device name
+# must change), since (device, seq) pairs already stored are skipped as duplicates.
+
+def parse_sensor_batch(sensor: str, data: dict) -> tuple[str, list, int]:
+    """
+    Validates a batch payload. Returns (device, [(seq, ts, {key: value})], rejected), where rejected counts
+    samples with a timestamp outside the accepted window. Raises ValueError if the batch is malformed.
+    """
+    device = data.get("device", sensor)
+    readings = data.get("readings")
+    if not isinstance(device, str) or not device or len(device) > 64:
+        raise ValueError("device must be a non-empty string of at most 64 characters")
+    if not isinstance(readings, list):
+        raise ValueError("readings must be a list")
+    if len(readings) > BATCH_MAX_READINGS:
+        raise ValueError(f"at most {BATCH_MAX_READINGS} readings per batch")
+
+    oldest, newest = hours_ago_ms(BATCH_MAX_AGE_HOURS), now_ms() + int(BATCH_MAX_CLOCK_SKEW * 1000)
+    samples = []
+    rejected = 0
+    for i, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            raise ValueError(f"readings[{i}] is not an object")
+        seq, ts = reading.get("seq"), reading.get("ts")
+        if type(seq) is not int or seq < 0 or type(ts) is not int:
+            raise ValueError(f"readings[{i}] needs an integer seq >= 0 and ts (epoch ms)")
+        if not oldest <= ts <= newest:
+            rejected += 1
+            continue
+        values = {}
+        for key, value in reading.items():
+            if key in ("seq", "ts") or key.lower() == 'rssi': continue
+            try: values[key] = float(value)
+            except (ValueError, TypeError): pass
+        samples.append((seq, ts, values))
+    return device, samples, rejected
+
+def prepare_sensor_batch(topic: str, device: str, samples: list) -> list:
+    """
+    [(device, seq, ts, topic, values, reading rows)] for store_sensor_batch; series ids are resolved here,
+    outside its transaction.
+    """
+    return [
+        (device, seq, ts, topic, values, [(get_series_id(topic, key), ts, value) for key, value in values.items()])
+        for seq, ts, values in samples
+    ]
+
+def store_sensor_batch(conn: sqlite3.Connection, samples: list) -> list:
+    """Stores prepared batch samples in the caller's transaction, skipping (device, seq) pairs already seen. Returns the stored samples."""
+    rows = []
+    stored = []
+    for sample in samples:
+        device, seq, ts, _, _, sample_rows = sample
+        if conn.execute("INSERT OR IGNORE INTO ingest_seq (device, seq, ts) VALUES (?, ?, ?)", (device, seq, ts)).rowcount:
+            rows.extend(sample_rows)
+            stored.append(sample)
+    if rows:
+        apply_db_write(conn, "readings", rows)
+    metrics.inc("greenhouse_batch_samples_total", len(stored), result="stored")
+    metrics.inc("greenhouse_batch_samples_total", len(samples) - len(stored), result="duplicate")
+    return stored
+
+def write_sensor_batch(topic: str, device: str, samples: list) -> list:
+    """
+    Stores one batch in its own transaction, committed before returning (HTTP ingest: the node may then drop
+    its buffer). Returns the stored samples; the rest were duplicates.
+    """
+    prepared = prepare_sensor_batch(topic, device, samples)
+    conn = get_db_connection()
+    try:
+        with conn:
+            result = store_sensor_batch(conn, prepared)
+        metrics.inc("greenhouse_db_commits_total", db="local")
+        return result
+    except sqlite3.Error:
+        known_partitions.clear()  # A rolled-back CREATE TABLE must be re-run
+        raise
+    finally:
+        conn.close()
+
+def publish_batch_latest(stored: list):
+    """
+    Feeds newly stored batch samples that are newer than the latest readings (a node flushing right after
+    reconnecting) to the snapshot and live clients. Duplicates never get here, so resent batches change nothing.
+    Timestamps are clamped to now: a node whose clock runs ahead (up to BATCH_MAX_CLOCK_SKEW) would otherwise
+    keep the snapshot from accepting live readings until its samples are in the past.
+    """
+    updates = {}
+    now = now_ms()
+    for _, _, ts, topic, values, _ in sorted(stored, key=lambda sample: sample[2]):
+        ts = min(ts, now)
+        for key in latest_snapshot.update(topic, values, ts):
+            updates[key.lower()] = {"timestamp": ms_to_iso(ts), "value": values[key]}
+    if updates:
+        live_hub.publish("readings", updates)
+
+def on_batch_message(topic: str, payload: bytes):
+    """MQTT batch ingest: queues the whole batch as one DB writer entry, so it is committed in a single transaction."""
+    sensor_topic, sensor = topic.rsplit("/", 1)[0], topic.split("/")[2]
+    if sensor_topic not in TOPICS:
+        print(f"    Warning: Batch for unknown sensor '{sensor}' ignored."); return
+    if len(payload) > BATCH_MAX_BYTES:
+        metrics.inc("greenhouse_errors_total", kind="batch")
+        print(f"    Warning: Batch of {len(payload)} bytes exceeds {BATCH_MAX_BYTES} bytes, ignored."); return
+    data = decode_sensor_payload(topic, payload)
+    if data is None:
+        metrics.inc("greenhouse_errors_total", kind="decode")
+        print(f"    Warning: Undecodable batch payload ({len(payload)} bytes)."); return
+    try:
+        device, samples, rejected = parse_sensor_batch(sensor, data)
+        prepared = prepare_sensor_batch(sensor_topic, device, samples)
+    except ValueError as e:
+        metrics.inc("greenhouse_errors_total", kind="batch")
+        print(f"    Warning: Invalid batch: {e}"); return
+    except sqlite3.Error as e:
+        metrics.inc("greenhouse_errors_total", kind="db_write")
+        print(f"[DB WRITE ERROR] Batch from {device} failed: {e}"); return
+    metrics.inc("greenhouse_batch_samples_total", rejected, result="rejected")
+    if prepared:
+        enqueue_db_write("batch", prepared)  # The writer publishes whatever it actually stores
+    print(f"    Batch from {device}: {len(samples)} samples queued, {rejected} rejected (timestamp out of range).")
+
+
 # ==================== MQTT Functions ====================
 
 def publish_config(topic: str, payload: str):
@@ -438,62 +1529,248 @@ def publish_config(topic: str, payload: str):
         print("[MQTT CONFIG ERROR] Client not connected. Configuration failed.")
         raise RuntimeError("MQTT client is not connected to the broker.")
 
+def publish_active_profile(client=None):
+    """Publishes the active profile as a retained message (best effort; controllers also poll)."""
+    client = client or mqtt_client
+    if not (client and client.is_connected()):
+        return
+    setpoints = dict(get_active_setpoints())
+    active_name = config_cache.active_name()
+    payload = json.dumps({"profile_name": active_name, "setpoints": setpoints})
+    client.publish(PROFILE_TOPIC, payload, qos=1, retain=True)
+    print(f"[MQTT CONFIG] Published active profile '{active_name}' to {PROFILE_TOPIC}")
+
 def on_connect(client, userdata, flags, reasoncode, properties):
     if reasoncode == 0:
         print("[MQTT] Connected successfully. Subscribing topics...")
-        for topic in TOPICS: client.subscribe(topic); print(f"    Subscribed: {topic}")
+        for topic in TOPICS + [BATCH_TOPIC]: client.subscribe(topic); print(f"    Subscribed: {topic}")
         # Initialize default setpoints if they don't exist
         get_active_setpoints() 
+        publish_active_profile(client)
     else: print(f"[MQTT] Connection failed, reasoncode={reasoncode}")
 
 def on_disconnect(client, userdata, flags, reasoncode, properties):
     print("[MQTT] Disconnected from broker. Will auto-reconnect...")
 
 def on_message(client, userdata, msg):
-    """Main control loop: reads sensor data, saves it, and executes hierarchical control logic."""
-    payload = msg.payload.decode("utf-8")
+    """Ingestion: reads sensor data, saves it, and updates the latest readings for the control loop."""
     topic = msg.topic
+    metrics.inc("greenhouse_messages_total", topic=topic)
     ts_str = datetime.now().strftime("%H:%M:%S")
+    if topic.endswith("/batch"):
+        print(f"\n[{ts_str}] Buffered readings ({topic}):")
+        with metrics.time("batch"):
+            on_batch_message(topic, msg.payload)
+        return
 
     device_name = { "greenhouse/sensor/air_th": "ESP32 Air_TH Sensor", "greenhouse/sensor/soil": "ESP32 Soil Sensor", "greenhouse/sensor/light": "ESP32 Light Sensor" }.get(topic, "Unknown Device")
     print(f"\n[{ts_str}] Data from {device_name} ({topic}):")
-    try: data = json.loads(payload)
-    except json.JSONDecodeError: print(f"    Warning: Non-JSON payload: {payload}"); return
+    with metrics.time("decode"):
+        data = decode_sensor_payload(topic, msg.payload)
+    if data is None:
+        metrics.inc("greenhouse_errors_total", kind="decode")
+        print(f"    Warning: Undecodable payload: {msg.payload!r}"); return
     for key, value in data.items(): print(f"    {key:>8}: {value}")
     
-    save_data_to_db(topic, data)
-    setpoints = get_active_setpoints()
-    active_profile = load_config_from_db(ACTIVE_PROFILE_KEY)
-    print(f"    [Profile] Active: {active_profile.get('name')}, VPD Target: {setpoints['vpd_target_low']:.2f}-{setpoints['vpd_target_high']:.2f} kPa")
+    with metrics.time("save_data_to_db"):
+        save_data_to_db(topic, data)
 
-    # ==================== 智能控制決策鏈 ====================
+    # 控制決策由固定頻率的控制迴圈執行，這裡只更新最新讀數
     if topic == "greenhouse/sensor/air_th":
         try:
             temp = float(data.get("temp"))
             hum = float(data.get("humidity"))
             co2 = float(data.get("co2"))
-            current_vpd = calculate_vpd(temp, hum)
-            print(f"      [VPD] Calculated VPD: {current_vpd:.2f} kPa")
-            
-            # 核心決策: VPD, Temp, CO2, Heater, Mister, Fan
-            control_climate(co2, temp, hum, current_vpd, setpoints)
-            
+            sensor_state.update("air", {"temp": temp, "hum": hum, "co2": co2})
         except (ValueError, TypeError) as e:
             print(f"    Error processing air data: {e}")
             
     elif topic == "greenhouse/sensor/soil":
         val = data.get("soil_raw") or data.get("value")
         if val is not None:
-            try: control_irrigation(float(val), setpoints)
+            try: sensor_state.update("soil", {"soil_raw": float(val)})
             except (ValueError, TypeError): pass
             
     elif topic == "greenhouse/sensor/light" and "lux" in data:
-        try: control_curtain(float(data["lux"]), setpoints)
+        try: sensor_state.update("light", {"lux": float(data["lux"])})
         except (ValueError, TypeError): pass
 
+# ==================== Sensor State & Control Loop ====================
+
+class SensorState:
+    """
+    Latest-value store shared between MQTT ingestion and the control loop.
+    Each channel ("air", "soil", "light") keeps its freshest values, arrival time and a sequence number.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # channel -> (values, monotonic arrival time, seq)
+
+    def update(self, channel: str, values: dict):
+        with self.lock:
+            seq = self.channels[channel][2] + 1 if channel in self.channels else 1
+            self.channels[channel] = (values, time.monotonic(), seq)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.channels)
+
+sensor_state = SensorState()
+control_stop_event = threading.Event()
+last_control_seq = {}
+
+def control_tick():
+    """
+    Evaluates the hierarchical control chain once using the freshest readings.
+    A channel is evaluated only if it received new data since the previous tick,
+    so a fast-publishing sensor costs at most one evaluation per tick.
+    """
+    now = time.monotonic()
+    due = {}
+    for channel, (values, arrived, seq) in sensor_state.snapshot().items():
+        if last_control_seq.get(channel) != seq and now - arrived <= SENSOR_STALE_AFTER:
+            last_control_seq[channel] = seq
+            due[channel] = values
+    if not due:
+        return
+
+    with metrics.time("get_active_setpoints"):
+        setpoints = get_active_setpoints()
+        active_name = config_cache.active_name()
+    print(f"    [Profile] Active: {active_name}, VPD Target: {setpoints['vpd_target_low']:.2f}-{setpoints['vpd_target_high']:.2f} kPa")
+
+    # ==================== 智能控制決策鏈 ====================
+    if "air" in due:
+        air = due["air"]
+        current_vpd = calculate_vpd(air["temp"], air["hum"])
+        print(f"      [VPD] Calculated VPD: {current_vpd:.2f} kPa")
+
+        # 核心決策: VPD, Temp, CO2, Heater, Mister, Fan
+        with metrics.time("control_climate"):
+            control_climate(air["co2"], air["temp"], air["hum"], current_vpd, setpoints)
+
+    if "soil" in due:
+        with metrics.time("control_irrigation"):
+            control_irrigation(due["soil"]["soil_raw"], setpoints)
+
+    if "light" in due:
+        with metrics.time("control_curtain"):
+            control_curtain(due["light"]["lux"], setpoints)
+
+def control_loop():
+    """Runs control_tick at a fixed rate of one tick per CONTROL_INTERVAL, independent of message arrival."""
+    next_tick = time.monotonic()
+    while not control_stop_event.is_set():
+        try:
+            control_tick()
+        except Exception as e:
+            metrics.inc("greenhouse_errors_total", kind="control")
+            print(f"[Control Error] Control tick failed: {e}")
+
+        next_tick += CONTROL_INTERVAL
+        delay = next_tick - time.monotonic()
+        if delay < 0:
+            # Tick overran: skip missed ticks instead of bursting to catch up
+            next_tick = time.monotonic()
+            delay = 0
+        control_stop_event.wait(delay)
+
+# ==================== API Encoding & Compression ====================
+
+def json_safe(value):
+    """Copy of value with NaN/inf floats replaced by None, as orjson encodes them."""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    return value
+
+def json_bytes(content) -> bytes:
+    """Compact, strict JSON as bytes: orjson when installed, else the standard library (NaN/inf become null either way)."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    try:
+        text = json.dumps(content, ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+    except ValueError:
+        # Rare: only content holding non-finite floats pays for the copy
+        text = json.dumps(json_safe(content), ensure_ascii=False, separators=(",", ":"), allow_nan=False)
+    return text.encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """Default API response class: encodes with json_bytes."""
+
+    def render(self, content) -> bytes:
+        return json_bytes(content)
+
+class BrotliResponder:
+    """Brotli-encodes one response (streamed bodies chunk by chunk) unless it is small, already encoded or a binary export."""
+
+    def __init__(self, app):
+        self.app = app
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        async def send_encoded(message):
+            if message["type"] == "http.response.start":
+                self.start = message  # Held until the first body part decides the headers
+                return
+            if message["type"] != "http.response.body" or self.passthrough:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if self.compressor is None:
+                headers = MutableHeaders(raw=self.start["headers"])
+                media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+                if ("content-encoding" in headers or media_type in COMPRESS_EXCLUDE_TYPES
+                        or (not more_body and len(body) < COMPRESS_MIN_BYTES)):
+                    self.passthrough = True
+                    await send(self.start)
+                    await send(message)
+                    return
+                self.compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+                body = self.compressor.process(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+                headers["Content-Encoding"] = "br"
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(body))
+                await send(self.start)
+            else:
+                body = self.compressor.process(body) + (self.compressor.flush() if more_body else self.compressor.finish())
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_encoded)
+
+class CompressionMiddleware:
+    """Negotiates response compression: brotli when the client accepts it and the module is installed, else gzip."""
+
+    def __init__(self, app):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=COMPRESS_MIN_BYTES, compresslevel=COMPRESS_GZIP_LEVEL,
+                                   exclude_content_types=DEFAULT_EXCLUDED_CONTENT_TYPES + COMPRESS_EXCLUDE_TYPES)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in COMPRESS_EXCLUDE_PATHS:
+            await self.app(scope, receive, send)
+            return
+        accepted = {token.split(";")[0].strip() for token in Headers(scope=scope).get("accept-encoding", "").split(",")}
+        if brotli is not None and "br" in accepted:
+            await BrotliResponder(self.app)(scope, receive, send)
+        else:
+            await self.gzip(scope, receive, send)
+
+
 # ==================== FastAPI API Routes ====================
 
-app = FastAPI(title="Greenhouse Sensor API")
+app = FastAPI(title="Greenhouse Sensor API", default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
 
 # Add CORS middleware
 app.add_middleware(
@@ -504,12 +1781,28 @@ app.add_middleware(
     allow_headers=["*"], 
 )
 
+@app.middleware("http")
+async def record_api_metrics(request: Request, call_next):
+    """Times every API request and counts it by route template (not raw path, to keep label cardinality bounded)."""
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = getattr(route, "path", "unmatched")
+    metrics.observe("greenhouse_stage_seconds", time.perf_counter() - start, stage="api")
+    metrics.inc("greenhouse_api_requests_total", route=path, status=str(response.status_code))
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # --- Configuration API Routes: Soil Calibration ---
 @app.post("/api/v1/config/soil")
 async def set_soil_calibration(config: SoilCalibration):
     if config.dry_adc <= config.wet_adc: raise HTTPException(status_code=400, detail="Dry ADC value must be greater than Wet ADC value for correct calculation.")
     config_dict = config.model_dump()
-    save_config_to_db(SOIL_CALIB_KEY, config_dict)
+    await run_db(save_config_to_db, SOIL_CALIB_KEY, config_dict)
     payload_data = {"cmd": "CALIBRATE_SOIL", "dry": config.dry_adc, "wet": config.wet_adc}
     payload = json.dumps(payload_data)
     try:
@@ -519,106 +1812,492 @@ async def set_soil_calibration(config: SoilCalibration):
 
 @app.get("/api/v1/config/soil")
 async def get_soil_calibration():
-    config = load_config_from_db(SOIL_CALIB_KEY)
+    config = await run_db(config_cache.soil_calib)
     if config is None: raise HTTPException(status_code=404, detail="Soil calibration configuration not found. Please set initial values.")
-    return config
+    return dict(config)
 
 # --- Plant Profiles API Routes ---
-@app.get("/api/v1/profiles")
-async def get_all_profiles():
-    conn = get_db_connection()
-    active_name_config = load_config_from_db(ACTIVE_PROFILE_KEY)
-    active_name = active_name_config.get('name') if active_name_config else DEFAULT_PROFILE_NAME
-    profiles = conn.execute("SELECT key, value FROM config_settings WHERE key LIKE 'profile_%'").fetchall()
-    conn.close()
+# Config reads go through run_db too: a config_cache miss (after any save) reloads from SQLite,
+# and get_active_setpoints may write the default profile.
+def profiles_overview() -> dict:
+    active_name = config_cache.active_name()
     result = {"active_profile": active_name, "profiles": {}}
-    for row in profiles:
-        profile_name = row['key'].replace('profile_', '')
-        try:
-            setpoints = json.loads(row['value'])
-            result["profiles"][profile_name] = ClimateSetpoints(**setpoints).model_dump()
-        except json.JSONDecodeError:
+    for profile_name, setpoints in config_cache.profiles().items():
+        if setpoints is None:
             result["profiles"][profile_name] = {"error": "Invalid JSON format in DB"}
+        else:
+            result["profiles"][profile_name] = dict(setpoints)
     if not result["profiles"] and active_name == DEFAULT_PROFILE_NAME:
-         result["profiles"][DEFAULT_PROFILE_NAME] = get_active_setpoints()
+         result["profiles"][DEFAULT_PROFILE_NAME] = dict(get_active_setpoints())
     return result
 
+@app.get("/api/v1/profiles")
+async def get_all_profiles():
+    return await run_db(profiles_overview)
+
 @app.post("/api/v1/profiles")
 async def save_plant_profile(profile: PlantProfile):
     if not profile.profile_name: raise HTTPException(status_code=400, detail="Profile name cannot be empty.")
     db_key = f"profile_{profile.profile_name}"
     setpoints_dict = profile.setpoints.model_dump()
-    save_config_to_db(db_key, setpoints_dict)
+    await run_db(save_config_to_db, db_key, setpoints_dict)
+    if await run_db(config_cache.active_name) == profile.profile_name:  # Reloads the invalidated cache off the loop
+        await run_db(publish_active_profile)
     return {"status": "success", "message": f"Profile '{profile.profile_name}' saved successfully.", "setpoints": setpoints_dict}
 
 @app.post("/api/v1/profiles/activate/{profile_name}")
 async def activate_profile(profile_name: str = Path(..., description="The name of the profile to activate.")):
-    db_key = f"profile_{profile_name}"
-    if load_config_from_db(db_key) is None: raise HTTPException(status_code=404, detail=f"Profile '{profile_name}' not found.")
-    save_config_to_db(ACTIVE_PROFILE_KEY, {'name': profile_name})
-    new_setpoints = get_active_setpoints()
+    if profile_name not in await run_db(config_cache.profiles): raise HTTPException(status_code=404, detail=f"Profile '{profile_name}' not found.")
+    await run_db(save_config_to_db, ACTIVE_PROFILE_KEY, {'name': profile_name})
+    new_setpoints = dict(await run_db(get_active_setpoints))
+    await run_db(publish_active_profile)
     print(f"[CONFIG] Activated new profile: {profile_name}")
     return {"status": "success", "message": f"Profile '{profile_name}' is now active.", "setpoints": new_setpoints}
 
 # --- Sensor Data API Routes ---
-def get_latest_value_from_db(value_key: str):
-    conn = get_db_connection()
-    latest_reading = conn.execute("""SELECT timestamp, value FROM sensor_readings WHERE value_key = ? ORDER BY id DESC LIMIT 1""", (value_key,)).fetchone()
-    conn.close()
-    if latest_reading: return {"timestamp": latest_reading['timestamp'], "value": latest_reading['value']}
-    else: return None
+@app.post("/api/v1/sensor/{sensor}/batch")
+async def ingest_sensor_batch(request: Request, sensor: str = Path(..., description="Sensor name, e.g. air_th.")):
+    """
+    Batch ingest of device-buffered readings (JSON or MessagePack body, see Batch Ingest). The batch is
+    committed in one transaction before the response, so the node may drop samples once it gets a 200.
+    """
+    topic = f"greenhouse/sensor/{sensor}"
+    if topic not in TOPICS: raise HTTPException(status_code=404, detail=f"Unknown sensor '{sensor}'.")
+    too_large = HTTPException(status_code=413, detail=f"Batch bodies are limited to {BATCH_MAX_BYTES} bytes.")
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > BATCH_MAX_BYTES: raise too_large
+    body = bytearray()
+    async for chunk in request.stream():  # Also caps chunked bodies, which carry no Content-Length
+        body += chunk
+        if len(body) > BATCH_MAX_BYTES: raise too_large
+    data = decode_sensor_payload(f"{topic}/batch", bytes(body))
+    if data is None: raise HTTPException(status_code=400, detail="Body must be a JSON or MessagePack object.")
+    try:
+        device, samples, rejected = parse_sensor_batch(sensor, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
+    metrics.inc("greenhouse_batch_samples_total", rejected, result="rejected")
+    try:
+        stored = await run_db(write_sensor_batch, topic, device, samples)
+    except sqlite3.Error as e:
+        metrics.inc("greenhouse_errors_total", kind="db_write")
+        print(f"[DB WRITE ERROR] Batch from {device} failed: {e}")
+        raise HTTPException(status_code=503, detail="Database busy; resend the batch.")
+    publish_batch_latest(stored)
+    return {"status": "success", "device": device, "stored": len(stored), "duplicates": len(samples) - len(stored), "rejected": rejected}
+
+@app.get("/api/v1/stream")
+async def stream_live_updates():
+    """
+    Server-Sent Events replacing latest/status polling: one "snapshot" event with the latest readings and
+    actuator states, then a "delta" event ({"readings": {...}, "actuators": {...}}) whenever values change.
+    """
+    if len(live_hub.subscribers) >= LIVE_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Too many live clients.")
+
+    async def events():
+        subscriber = live_hub.subscribe()  # Before the snapshot, so no change falls between the two
+        try:
+            yield sse_event("snapshot", {"readings": latest_snapshot.get()[1], "actuators": actuator_states()})
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.wakeup.wait(), LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                delta = live_hub.take(subscriber)
+                if delta:
+                    yield sse_event("delta", delta)
+        finally:
+            live_hub.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match names etag (or is *)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
 
 @app.get("/api/v1/latest")
-async def get_latest_data():
-    conn = get_db_connection()
-    latest_data = conn.execute("""
-        SELECT t1.timestamp, t1.topic, t1.value_key, t1.value
-        FROM sensor_readings t1
-        INNER JOIN (
-            SELECT MAX(id) AS max_id FROM sensor_readings GROUP BY topic, value_key
-        ) t2 ON t1.id = t2.max_id ORDER BY t1.timestamp DESC
-    """).fetchall()
-    conn.close()
-    result = {}
-    for row in latest_data:
-        key = row['value_key'].lower()
-        result[key] = {"timestamp": row['timestamp'], "value": row['value']}
-    return result
+async def get_latest_data(request: Request):
+    """Newest value of every sensor key, from the in-memory snapshot. Polls with a matching If-None-Match get 304."""
+    etag, latest = latest_snapshot.get()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(latest, headers=headers)
 
 @app.get("/api/v1/latest/{value_key}")
-async def get_latest_value(value_key: str):
-    db_key = value_key.lower() 
-    data = get_latest_value_from_db(db_key)
+async def get_latest_value(value_key: str, request: Request):
+    etag, latest = latest_snapshot.get()
+    data = latest.get(value_key.lower())
     if data is None: raise HTTPException(status_code=404, detail=f"Sensor key '{value_key}' not found or no data recorded.")
-    return data
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(data, headers=headers)
+
+def pick_history_resolution(hours: float, target_points: int = HISTORY_TARGET_POINTS) -> str:
+    """Coarsest rollup that still gives target_points points over the range, else raw."""
+    for name, seconds in reversed(ROLLUP_RESOLUTIONS.items()):
+        if hours * 3600 / seconds >= target_points:
+            return name
+    return "raw"
+
+def parse_history_cursor(after: str | None, fields: int) -> tuple | None:
+    """Splits an X-Next-Cursor value ("ts:series" for raw readings, "bucket" for rollups) back into integers."""
+    if after is None:
+        return None
+    try:
+        values = tuple(int(part) for part in after.split(":"))
+    except ValueError:
+        values = ()
+    if len(values) != fields:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor '{after}'.")
+    return values
+
+def check_history_paging(stream: str | None, limit: int | None, max_points: int | None, shape: str):
+    if stream is not None and stream not in HISTORY_STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown stream format '{stream}'. Use {', '.join(HISTORY_STREAM_FORMATS)}.")
+    if shape not in HISTORY_SHAPES:
+        raise HTTPException(status_code=400, detail=f"Unknown shape '{shape}'. Use {', '.join(HISTORY_SHAPES)}.")
+    if shape == "columns" and stream is not None:
+        raise HTTPException(status_code=400, detail="shape=columns is not available for streamed responses.")
+    if limit is not None and not 1 <= limit <= HISTORY_PAGE_MAX:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {HISTORY_PAGE_MAX}.")
+    if max_points is not None:
+        if not LTTB_MIN_POINTS <= max_points <= HISTORY_PAGE_MAX:
+            raise HTTPException(status_code=400, detail=f"max_points must be between {LTTB_MIN_POINTS} and {HISTORY_PAGE_MAX}.")
+        if limit is not None:
+            raise HTTPException(status_code=400, detail="max_points downsamples the whole range and cannot be combined with limit.")
+
+# ---------- LTTB downsampling ----------
+
+def lttb_pick(selected: tuple, bucket: list, cx: float, cy: float) -> tuple:
+    """Row of the bucket forming the largest triangle with the previously selected row and the point (cx, cy)."""
+    ax, ay = selected[1], selected[2]
+    if np is not None:
+        xs = np.fromiter((row[1] for row in bucket), dtype=float, count=len(bucket))
+        ys = np.fromiter((row[2] for row in bucket), dtype=float, count=len(bucket))
+        return bucket[int(np.abs((ax - cx) * (ys - ay) - (ax - xs) * (cy - ay)).argmax())]
+    return max(bucket, key=lambda row: abs((ax - cx) * (row[2] - ay) - (ax - row[1]) * (cy - ay)))
+
+def lttb(rows, start: float, end: float, max_points: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling of (cursor, x, y, row) history rows in x order.
+    Buckets are max_points - 2 equal time slices of [start, end]; the first and last rows are always kept,
+    empty slices are skipped, and only the current and next bucket are held in memory.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    yield first
+
+    last = []
+    def hold_last():
+        previous = None
+        for row in rows:
+            if previous is not None:
+                yield previous
+            previous = row
+        if previous is not None:
+            last.append(previous)
+
+    slices = max_points - 2
+    width = max(end - start, 1) / slices
+    def buckets():
+        bucket, index = [], None
+        for row in hold_last():
+            i = min(max(int((row[1] - start) / width), 0), slices - 1)
+            if i != index and bucket:
+                yield bucket
+                bucket = []
+            index = i
+            bucket.append(row)
+        if bucket:
+            yield bucket
+
+    selected = first
+    bucket_iter = buckets()
+    current = next(bucket_iter, None)
+    while current is not None:
+        following = next(bucket_iter, None)
+        if following is not None:
+            cx = sum(row[1] for row in following) / len(following)
+            cy = sum(row[2] for row in following) / len(following)
+        else:
+            cx, cy = last[0][1], last[0][2]
+        selected = lttb_pick(selected, current, cx, cy)
+        yield selected
+        current = following
+    if last:
+        yield last[0]
+
+def iter_sensor_history(conn: sqlite3.Connection, db_key: str, resolution: str, time_threshold: int, after: tuple | None):
+    """Yields (cursor, ts, value, row) of one sensor key in time order, read lazily from the SQLite cursors."""
+    series = get_series_for_key(conn, db_key)
+    if not series:
+        return
+    placeholders = ",".join("?" * len(series))
+    if resolution == "raw":
+        after_ts, after_series = after or (time_threshold, 0)
+        # Partitions are time-ordered, so walking them in turn keeps the output sorted
+        for table in list_partitions(conn, "readings", month_of_ms(max(time_threshold, after_ts))):
+            rows = conn.execute(
+                f"""SELECT series_id, ts, value FROM {table}
+                    WHERE series_id IN ({placeholders}) AND ts > ? AND ts >= ? AND (ts > ? OR series_id > ?)
+                    ORDER BY ts ASC, series_id ASC""",
+                (*series, time_threshold, after_ts, after_ts, after_series)
+            )
+            for row in rows:
+                yield f"{row['ts']}:{row['series_id']}", row['ts'], row['value'], row
+    else:
+        seconds = ROLLUP_RESOLUTIONS[resolution]
+        start = bucket_floor(time_threshold, seconds)
+        if after is not None:
+            start = max(start, after[0] + 1)
+        rows = conn.execute(
+            f"""SELECT bucket, MIN(min) AS min, MAX(max) AS max, SUM(sum) AS sum, SUM(count) AS count FROM rollups
+                WHERE resolution = ? AND series_id IN ({placeholders}) AND bucket >= ?
+                GROUP BY bucket ORDER BY bucket ASC""",
+            (seconds, *series, start)
+        )
+        for row in rows:
+            if row['count']:
+                yield str(row['bucket']), row['bucket'], row['sum'] / row['count'], row
+
+def sensor_history_format(db_key: str, resolution: str) -> tuple:
+    """(fields, values) where values(row) turns a row of iter_sensor_history into the tuple of its point's fields."""
+    if resolution == "raw":
+        return ("timestamp", db_key), lambda row: (ms_to_iso(row['ts']), row['value'])
+    return ("timestamp", db_key, "min", "max", "count"), lambda row: (
+        ms_to_iso(row['bucket']), row['sum'] / row['count'], row['min'], row['max'], row['count']
+    )
+
+FAN_HISTORY_FIELDS = ("timestamp", "duty_cycle", "status")
+
+def iter_fan_history(conn: sqlite3.Connection, time_threshold: str, after: str | None):
+    """Yields (cursor, ts, duty_cycle, row) of fan log entries in time order; the cursor is the entry's timestamp."""
+    start = max(time_threshold, after or "")
+    for table in list_partitions(conn, "fan_logs", month_of_iso(start)):
+        rows = conn.execute(
+            f"""SELECT timestamp, duty_cycle, status FROM {table} WHERE timestamp > ? ORDER BY timestamp ASC""",
+            (start,)
+        )
+        for row in rows:
+            yield row['timestamp'], datetime.fromisoformat(row['timestamp']).timestamp() * 1000, row['duty_cycle'], row
+
+def history_stream_chunks(conn: sqlite3.Connection, query, fields: tuple, values, fmt: str, limit: int | None):
+    """Encodes the rows of query(conn) as NDJSON lines or one JSON array of points, HISTORY_STREAM_CHUNK points per chunk."""
+    points = (dict(zip(fields, values(row))) for *_, row in itertools.islice(query(conn), limit))
+    if fmt == "ndjson":
+        pieces = (json_bytes(point) + b"\n" for point in points)
+    else:
+        pieces = itertools.chain([b"["], ((b"," if i else b"") + json_bytes(point) for i, point in enumerate(points)), [b"]"])
+    while chunk := b"".join(itertools.islice(pieces, HISTORY_STREAM_CHUNK)):
+        yield chunk
+
+async def stream_from_db(open_chunks):
+    """Sends the byte chunks of the generator open_chunks(conn), reading each one on the DB read pool."""
+    # Each chunk may be read by a different worker, so the connection must not be thread-bound
+    conn = get_db_connection(check_same_thread=False)
+    reading = None
+    try:
+        chunks = open_chunks(conn)
+        while True:
+            reading = db_read_executor.submit(next, chunks, b"")
+            chunk = await asyncio.wrap_future(reading)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # A client that disconnects mid-chunk leaves the read running: close the connection once it is done
+        if reading is None:
+            conn.close()
+        else:
+            reading.add_done_callback(lambda _: conn.close())
+
+def read_history_page(query, values, limit: int | None) -> list:
+    """[(cursor, values(row))] of the first limit + 1 rows of query, read on the calling worker's connection."""
+    rows = query(read_connection())
+    try:
+        return [(cursor, values(row)) for cursor, *_, row in itertools.islice(rows, None if limit is None else limit + 1)]
+    finally:
+        rows.close()  # Finalizes the open statement, so its read transaction does not hold back WAL checkpoints
+
+async def history_response(query, fields: tuple, values, stream: str | None, limit: int | None,
+                           shape: str = "rows", not_found: str | None = None):
+    """
+    Serves the (cursor, x, y, row) history rows of query(conn) as points with the given fields (values(row)).
+    stream=ndjson|json sends points as they are read from SQLite; otherwise returns at most limit points,
+    with X-Next-Cursor set (pass it back as after=) when more remain: a list of point objects, or for
+    shape=columns one object of per-field arrays.
+    """
+    if stream is not None:
+        return StreamingResponse(
+            stream_from_db(lambda conn: history_stream_chunks(conn, query, fields, values, stream, limit)),
+            media_type=HISTORY_STREAM_FORMATS[stream]
+        )
+    if shape == "rows":
+        values = lambda row, values=values: dict(zip(fields, values(row)))
+    page = await run_db(read_history_page, query, values, limit)
+    headers = {}
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        headers["X-Next-Cursor"] = page[-1][0]
+    if not page and not_found:
+        raise HTTPException(status_code=404, detail=not_found)
+    if shape == "columns":
+        columns = zip(*(item for _, item in page)) if page else [()] * len(fields)
+        return FastJSONResponse({field: list(column) for field, column in zip(fields, columns)}, headers=headers)
+    return FastJSONResponse([item for _, item in page], headers=headers)
 
 @app.get("/api/v1/history/{value_key}")
-async def get_generic_history(value_key: str, hours: int = 24):
-    conn = get_db_connection()
-    time_threshold = (datetime.now() - timedelta(hours=hours)).isoformat()
+async def get_generic_history(value_key: str, hours: int = 24, resolution: str = "auto", after: str | None = None,
+                              limit: int | None = None, stream: str | None = None, max_points: int | None = None,
+                              shape: str = "rows"):
+    """
+    History of one sensor key. resolution: raw, minute, hour, day, or auto (picked from the range).
+    Rollup points carry the bucket average under the key, plus min, max and count.
+    Page with limit (next page: after=<X-Next-Cursor>), or stream=ndjson|json to stream the whole range.
+    max_points downsamples the range with LTTB for charts, keeping spikes visible.
+    shape=columns returns {"timestamp": [...], key: [...], ...} instead of one object per point.
+    """
+    if resolution == "auto":
+        resolution = pick_history_resolution(hours, max(HISTORY_TARGET_POINTS, max_points or 0))
+    if resolution != "raw" and resolution not in ROLLUP_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown resolution '{resolution}'. Use auto, raw, {', '.join(ROLLUP_RESOLUTIONS)}.")
+    check_history_paging(stream, limit, max_points, shape)
+    cursor = parse_history_cursor(after, 2 if resolution == "raw" else 1)
+
+    time_threshold = hours_ago_ms(hours)
     db_key = value_key.lower()
-    data = conn.execute(
-        f"""SELECT timestamp, value FROM sensor_readings WHERE value_key = ? AND timestamp > ? ORDER BY timestamp ASC""",
-        (db_key, time_threshold,)
-    ).fetchall()
-    conn.close()
-    if not data:
-        if hours == 24: raise HTTPException(status_code=404, detail=f"No historical data found for key: '{value_key}'")
-        else: return []
-    history = [{"timestamp": row['timestamp'], value_key.lower(): row['value']} for row in data]
-    return history
+    not_found = f"No historical data found for key: '{value_key}'" if hours == 24 and after is None else None
+    if max_points is None:
+        query = lambda conn: iter_sensor_history(conn, db_key, resolution, time_threshold, cursor)
+    else:
+        start = time_threshold if cursor is None else max(time_threshold, cursor[0])
+        query = lambda conn: lttb(iter_sensor_history(conn, db_key, resolution, time_threshold, cursor), start, now_ms(), max_points)
+    fields, values = sensor_history_format(db_key, resolution)
+    return await history_response(query, fields, values, stream, limit, shape, not_found)
+
+def fold_aligned_history(rows, series_keys: dict, keys: list) -> tuple[list, dict]:
+    """
+    Folds (t, series_id, sum, count) rows, ordered by t, into one shared timestamp list and one value list
+    per key (average over the key's series at that time, None where the key has no data).
+    """
+    timestamps = []
+    sums = {key: [] for key in keys}
+    counts = {key: [] for key in keys}
+    for t, series_id, total, count in rows:
+        if not timestamps or timestamps[-1] != t:
+            timestamps.append(t)
+            for key in keys:
+                sums[key].append(0.0)
+                counts[key].append(0)
+        key = series_keys[series_id]
+        sums[key][-1] += total
+        counts[key][-1] += count
+    values = {key: [total / count if count else None for total, count in zip(sums[key], counts[key])] for key in keys}
+    return [ms_to_iso(t) for t in timestamps], values
+
+def read_multi_history(db_keys: list, resolution: str, time_threshold: int) -> tuple[list, dict]:
+    """Reads the aligned history of db_keys in one pass on the calling worker's connection."""
+    conn = read_connection()
+    placeholders = ",".join("?" * len(db_keys))
+    series_keys = dict(conn.execute(f"SELECT id, value_key FROM series WHERE value_key IN ({placeholders})", db_keys).fetchall())
+    placeholders = ",".join("?" * len(series_keys))
+    if not series_keys:
+        rows = []
+    elif resolution == "raw":
+        # Partitions are time-ordered, so chaining them keeps the rows sorted by ts
+        rows = itertools.chain.from_iterable(
+            conn.execute(
+                f"""SELECT ts, series_id, value, 1 FROM {table}
+                    WHERE series_id IN ({placeholders}) AND ts > ? ORDER BY ts ASC""",
+                (*series_keys, time_threshold)
+            )
+            for table in list_partitions(conn, "readings", month_of_ms(time_threshold))
+        )
+    else:
+        seconds = ROLLUP_RESOLUTIONS[resolution]
+        rows = conn.execute(
+            f"""SELECT bucket, series_id, sum, count FROM rollups
+                WHERE resolution = ? AND series_id IN ({placeholders}) AND bucket >= ? ORDER BY bucket ASC""",
+            (seconds, *series_keys, bucket_floor(time_threshold, seconds))
+        )
+    return fold_aligned_history(rows, series_keys, db_keys)
+
+@app.get("/api/v1/history")
+async def get_multi_history(keys: str, hours: int = 24, resolution: str = "auto"):
+    """
+    History of several sensor keys (keys=temp,hum,co2) in one pass, column-oriented:
+    {"resolution", "timestamps": [...], "values": {key: [...]}} with every value list aligned to timestamps.
+    raw aligns on reading time (keys of one sensor message share it); minute/hour/day align on rollup buckets.
+    """
+    db_keys = list(dict.fromkeys(key.strip().lower() for key in keys.split(",") if key.strip()))
+    if not db_keys:
+        raise HTTPException(status_code=400, detail="keys must list at least one sensor key.")
+    if resolution == "auto":
+        resolution = pick_history_resolution(hours)
+    if resolution != "raw" and resolution not in ROLLUP_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown resolution '{resolution}'. Use auto, raw, {', '.join(ROLLUP_RESOLUTIONS)}.")
+
+    timestamps, values = await run_db(read_multi_history, db_keys, resolution, hours_ago_ms(hours))
+    return {"resolution": resolution, "timestamps": timestamps, "values": values}
 
 @app.get("/api/v1/fan/history")
-async def get_fan_history(hours: int = 24):
-    conn = get_db_connection()
-    time_threshold = (datetime.now() - timedelta(hours=hours)).isoformat()
-    data = conn.execute(
-        """SELECT timestamp, duty_cycle, status FROM fan_logs WHERE timestamp > ? ORDER BY timestamp ASC""",
-        (time_threshold,)
-    ).fetchall()
-    conn.close()
-    history = [dict(row) for row in data]
-    return history
+async def get_fan_history(hours: int = 24, after: str | None = None, limit: int | None = None,
+                          stream: str | None = None, max_points: int | None = None, shape: str = "rows"):
+    """Fan log entries. Paged, streamed, downsampled (on duty_cycle) and shaped like the sensor history; the cursor is an entry timestamp."""
+    check_history_paging(stream, limit, max_points, shape)
+    if after is not None:
+        try:
+            datetime.fromisoformat(after)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor '{after}'.")
+    since = datetime.now() - timedelta(hours=hours)
+    time_threshold = since.isoformat()
+    if max_points is None:
+        query = lambda conn: iter_fan_history(conn, time_threshold, after)
+    else:
+        start = max(since, datetime.fromisoformat(after)) if after is not None else since
+        query = lambda conn: lttb(iter_fan_history(conn, time_threshold, after), start.timestamp() * 1000, now_ms(), max_points)
+    return await history_response(query, FAN_HISTORY_FIELDS, tuple, stream, limit, shape)
+
+@app.get("/api/v1/export")
+async def export_history(kind: str = "readings", fmt: str = Query("csv", alias="format"), hours: float = 24,
+                         start: str | None = None, end: str | None = None, keys: str | None = None):
+    """
+    Bulk export for offline analysis, streamed batch by batch: kind=readings|fan_logs, format=csv|parquet|arrow
+    (Arrow IPC stream; both need pyarrow). Range [start, end) in local ISO time, end defaulting to now and start
+    to hours before end; keys=temp,humidity limits readings to those keys. Same output as export_data.py.
+    """
+    if kind not in export_data.EXPORT_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind '{kind}'. Use {', '.join(export_data.EXPORT_KINDS)}.")
+    try:
+        export_data.check_export_format(fmt)
+    except RuntimeError as e:
+        raise HTTPException(status_code=501 if fmt in export_data.EXPORT_FORMATS else 400, detail=str(e))
+    try:
+        end_time = datetime.fromisoformat(end) if end else datetime.now()
+        start_time = datetime.fromisoformat(start) if start else end_time - timedelta(hours=hours)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid start/end: {e}")
+    start_ms, end_ms = int(start_time.timestamp() * 1000), int(end_time.timestamp() * 1000)
+    if start_ms >= end_ms:
+        raise HTTPException(status_code=400, detail="start must be before end.")
+    db_keys = [key.strip().lower() for key in keys.split(",") if key.strip()] if keys else None
+
+    filename = export_data.export_filename(kind, fmt, start_ms, end_ms)
+    return StreamingResponse(
+        stream_from_db(lambda conn: export_data.export_chunks(conn, kind, fmt, start_ms, end_ms, db_keys)),
+        media_type=export_data.EXPORT_FORMATS[fmt][0],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 # ==================== Main Execution ====================
 
@@ -632,6 +2311,7 @@ async def main_async():
     global mqtt_client 
     init_db()
     init_default_profiles()
+    start_db_writer()
     
     # Use CallbackAPIVersion.VERSION2 for paho-mqtt 2.0+ compatibility
     client = mqtt.Client(client_id=CLIENT_ID, protocol=mqtt.MQTTv5, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
@@ -643,6 +2323,9 @@ async def main_async():
     client.loop_start() 
     
     mqtt_client = client
+
+    control_thread = threading.Thread(target=control_loop, name="control_loop", daemon=True)
+    control_thread.start()
     
     server = Server(app, host="0.0.0.0", port=API_PORT)
     server_task = asyncio.create_task(server.serve())
@@ -656,7 +2339,11 @@ async def main_async():
         print("[System] Shutting down services...")
         client.loop_stop()
         client.disconnect()
+        control_stop_event.set()
+        control_thread.join(5.0)
         set_fan_duty(0)
+        stop_db_writer()
+        db_read_executor.shutdown(wait=False, cancel_futures=True)
         pwm.stop()
         try:
             # Clean up GPIO pins
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+MQTT traffic record/replay benchmark for the on_message hot path.
+
+Record live traffic:
+    python3 mqtt_replay.py record traffic.jsonl --duration 600
+
+Replay it into a controller with stand-ins for RPi.GPIO and the remote API:
+    python3 mqtt_replay.py replay traffic.jsonl --target mqtt.py --speed 0
+    python3 mqtt_replay.py replay traffic.jsonl --target mqtt_localSQL.py --speed 10
+
+--speed 1 replays in real time, N replays N times faster, 0 replays as fast as possible.
+The clock stops once every message has been processed and the pending uploads or DB writes are flushed;
+readings the controller dropped from its bounded queues are reported next to the throughput.
+"""
+import argparse
+import base64
+import importlib.util
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+
+BROKER = "127.0.0.1"
+PORT = 1883
+
+
+# ==================== Recording ====================
+
+def record(path: str, topics: list, duration: float):
+    """Subscribes to the broker and appends every message (arrival offset, topic, payload) to a JSONL file."""
+    import paho.mqtt.client as mqtt
+
+    start = time.monotonic()
+    count = 0
+    lock = threading.Lock()
+    out = open(path, "w")
+
+    def on_connect(client, userdata, flags, reasoncode, properties):
+        for topic in topics:
+            client.subscribe(topic)
+        print(f"[Record] Connected, recording {', '.join(topics)} to {path}")
+
+    def on_message(client, userdata, msg):
+        nonlocal count
+        line = json.dumps({
+            "t": round(time.monotonic() - start, 6),
+            "topic": msg.topic,
+            "payload": base64.b64encode(msg.payload).decode("ascii")
+        })
+        with lock:
+            out.write(line + "\n")
+            count += 1
+
+    client = mqtt.Client(client_id="greenhouse_recorder", protocol=mqtt.MQTTv5, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(BROKER, PORT, keepalive=60)
+    client.loop_start()
+    try:
+        while duration <= 0 or time.monotonic() - start < duration:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        with lock:
+            out.close()
+    print(f"[Record] Saved {count} messages in {time.monotonic() - start:.1f}s.")
+
+
+# ==================== Stand-ins ====================
+
+def install_fake_gpio():
+    """Registers an in-memory RPi.GPIO module so the controllers can be imported off the Pi."""
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM, gpio.OUT, gpio.IN, gpio.HIGH, gpio.LOW = 11, 0, 1, 1, 0
+    gpio.pins = {}
+    gpio.writes = 0
+
+    def output(pin, value):
+        gpio.pins[pin] = value
+        gpio.writes += 1
+
+    class PWM:
+        def __init__(self, pin, freq):
+            self.duty = 0
+
+        def start(self, duty):
+            self.duty = duty
+
+        def ChangeDutyCycle(self, duty):
+            self.duty = duty
+            gpio.writes += 1
+
+        def stop(self):
+            pass
+
+    gpio.setwarnings = lambda flag: None
+    gpio.setmode = lambda mode: None
+    gpio.setup = lambda pin, mode: gpio.pins.setdefault(pin, 0)
+    gpio.output = output
+    gpio.input = lambda pin: gpio.pins.get(pin, 0)
+    gpio.cleanup = lambda: None
+    gpio.PWM = PWM
+
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+    return gpio
+
+class FakeResponse:
+    status_code = 200
+    text = "{}"
+    headers = {}
+
+    def json(self):
+        return {}
+
+class FakeSession:
+    """Stand-in for the remote API session: answers 200 after an optional latency, counts calls per path and uploaded readings."""
+
+    def __init__(self, base_url: str, latency: float):
+        self.base_url = base_url
+        self.latency = latency
+        self.calls = Counter()
+        self.readings = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        path = url.replace(self.base_url, "")
+        readings = 0
+        if path == "/sensors/batch" and kwargs.get("data"):
+            readings = len(json.loads(kwargs["data"]).get("readings", []))
+        with self.lock:
+            self.calls[f"{method} {path}"] += 1
+            self.readings += readings
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+class IngestTracker:
+    """
+    Wraps a headless controller's ingest step, which its zone workers run for every queued message,
+    to count processed messages and record when each payload finished (for end-to-end latency).
+    """
+
+    def __init__(self, target):
+        self.processed = 0
+        self.finished = {}  # id(payload) -> perf_counter() when its ingest returned
+        self.lock = threading.Lock()
+        ingest = target.ingest_sensor_message
+
+        def tracked(zone, topic, sensor_type, raw):
+            try:
+                ingest(zone, topic, sensor_type, raw)
+            finally:
+                with self.lock:
+                    self.processed += 1
+                    self.finished[id(raw)] = time.perf_counter()
+
+        target.ingest_sensor_message = tracked
+
+class WriteCounter:
+    """Counts write statements and commits on every SQLite connection opened after install()."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def trace(self, statement: str):
+        verb = statement.lstrip().split(" ", 1)[0].upper()
+        if verb in ("INSERT", "UPDATE", "DELETE", "REPLACE", "COMMIT"):
+            with self.lock:
+                self.counts[verb] += 1
+
+    def install(self):
+        real_connect = sqlite3.connect
+
+        def connect(*args, **kwargs):
+            conn = real_connect(*args, **kwargs)
+            conn.set_trace_callback(self.trace)
+            return conn
+
+        sqlite3.connect = connect
+
+
+# ==================== Replay ====================
+
+def load_target(path: str):
+    """Imports a controller script as a module (its __main__ block does not run)."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_messages(path: str) -> list:
+    messages = []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                messages.append((entry["t"], entry["topic"], base64.b64decode(entry["payload"])))
+    return messages
+
+def prepare_target(target, workdir: str, api_latency: float):
+    """Points the controller at throwaway storage and stand-in services. Returns the fake API session, if any."""
+    session = None
+    if hasattr(target, "api"):
+        # Headless controller: remote API stand-in, local spool in the work dir
+        session = FakeSession(target.REMOTE_API_BASE, api_latency)
+        target.api.session = session
+        target.SPOOL_DB = os.path.join(workdir, "upload_spool.db")
+        target.init_spool()
+        target.start_upload_worker()
+        target.get_zone(target.DEFAULT_ZONE)
+    if hasattr(target, "DB_NAME"):
+        # Local SQLite controller: fresh database in the work dir
+        target.DB_NAME = os.path.join(workdir, "greenhouse_data.db")
+        target.init_db()
+        target.init_default_profiles()
+        target.start_db_writer()
+        target.control_stop_event.clear()
+        threading.Thread(target=target.control_loop, name="control_loop", daemon=True).start()
+    return session
+
+def drain_target(target, tracker: IngestTracker | None, routed: int, timeout: float = 30.0) -> float:
+    """
+    Waits until the controller has processed (or dropped) every routed message, then stops its workers so
+    pending control events, uploads and DB writes are flushed. An empty queue is not enough: a worker may
+    still hold a message. Returns the monotonic time at which processing finished.
+    """
+    deadline = time.monotonic() + timeout
+    if tracker is not None:
+        while time.monotonic() < deadline and tracker.processed + dropped_counts(target).get("zone queues", 0) < routed:
+            time.sleep(0.001)
+    if hasattr(target, "db_write_queue"):
+        while time.monotonic() < deadline and not target.db_write_queue.empty():
+            time.sleep(0.001)
+    processed = time.monotonic()
+    if hasattr(target, "stop_zone_workers"):
+        # Zone workers first: their last control tick may still queue actuator events
+        target.stop_zone_workers()
+        target.stop_upload_worker()  # Sends the queued uploads and the pending batch
+    if hasattr(target, "stop_db_writer"):
+        # Flushes the writer's last group transaction
+        target.stop_db_writer()
+    return processed
+
+def dropped_counts(target) -> dict:
+    """Entries the controller discarded from its bounded queues, by queue."""
+    counts = {}
+    if hasattr(target, "zones"):
+        counts["zone queues"] = sum(zone.dropped for zone in list(target.zones.values()))
+    if hasattr(target, "upload_dropped"):
+        counts["upload queue"] = target.upload_dropped
+    if hasattr(target, "db_write_dropped"):
+        counts["DB write queue"] = target.db_write_dropped
+    return counts
+
+def stop_target(target):
+    if hasattr(target, "stop_zone_workers"):
+        target.stop_zone_workers()
+        target.stop_upload_worker()
+        target.close_spool()
+    if hasattr(target, "control_stop_event"):
+        target.control_stop_event.set()
+    if hasattr(target, "stop_db_writer"):
+        target.stop_db_writer()
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def replay(path: str, target_path: str, speed: float, api_latency: float, quiet: bool):
+    messages = load_messages(path)
+    if not messages:
+        print("[Replay] No messages to replay.")
+        return
+
+    gpio = install_fake_gpio()
+    writes = WriteCounter()
+    writes.install()
+    workdir = tempfile.mkdtemp(prefix="greenhouse_replay_")
+
+    real_stdout = sys.stdout
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+
+    target = load_target(target_path)
+    session = prepare_target(target, workdir, api_latency)
+    tracker = IngestTracker(target) if hasattr(target, "ingest_sensor_message") else None
+    from paho.mqtt.client import MQTTMessage
+
+    latencies = []
+    sent_at = {}  # id(payload) -> perf_counter() before on_message, for messages routed to a zone worker
+    start = time.monotonic()
+    first_t = messages[0][0]
+    try:
+        for t, topic, payload in messages:
+            if speed > 0:
+                delay = (t - first_t) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            msg = MQTTMessage(topic=topic.encode())
+            msg.payload = payload
+            began = time.perf_counter()
+            target.on_message(None, None, msg)
+            latencies.append(time.perf_counter() - began)
+            if tracker is not None and target.parse_sensor_topic(topic) is not None:
+                sent_at[id(payload)] = began
+        processed = drain_target(target, tracker, len(sent_at)) - start
+        elapsed = time.monotonic() - start
+    finally:
+        stop_target(target)
+        sys.stdout = real_stdout
+
+    def latency_line(values: list) -> str:
+        return (f"p50 {percentile(values, 50) * 1000:.3f}  p90 {percentile(values, 90) * 1000:.3f}  "
+                f"p99 {percentile(values, 99) * 1000:.3f}  max {values[-1] * 1000:.3f}")
+
+    latencies.sort()
+    dropped = dropped_counts(target)
+    dropped_total = sum(dropped.values())
+    print(f"[Replay] Target: {target_path}  Messages: {len(messages)}  Speed: {'max' if speed <= 0 else f'{speed:g}x'}")
+    print(f"    Duration:      {processed:.3f} s processed, {elapsed:.3f} s until uploads and writes were flushed")
+    print(f"    Throughput:    {len(messages) / processed:.1f} msg/s  dropped {dropped_total} "
+          f"({dropped_total / len(messages):.1%})" + "".join(f"  {name}: {count}" for name, count in dropped.items()))
+    print(f"    on_message (ms): {latency_line(latencies)}")
+    if tracker is not None:
+        end_to_end = sorted(tracker.finished[key] - began for key, began in sent_at.items() if key in tracker.finished)
+        if end_to_end:
+            print(f"    Processed (ms):  {latency_line(end_to_end)}  ({len(end_to_end)} readings, queueing included)")
+    print(f"    GPIO writes:   {gpio.writes}")
+    if session is not None:
+        print(f"    HTTP calls:    {sum(session.calls.values())}  (readings uploaded: {session.readings})")
+        for name, count in sorted(session.calls.items()):
+            print(f"        {name:<28} {count}")
+    print(f"    DB writes:     {writes.counts['INSERT'] + writes.counts['UPDATE'] + writes.counts['DELETE'] + writes.counts['REPLACE']}"
+          f"  (commits: {writes.counts['COMMIT']})")
+
+
+# ==================== Main Execution ====================
+
+def main():
+    parser = argparse.ArgumentParser(description="Record MQTT traffic and replay it through the greenhouse controllers.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="Record live MQTT traffic to a JSONL file.")
+    rec.add_argument("file")
+    rec.add_argument("--topic", action="append", help="Topic filter (repeatable, default greenhouse/#).")
+    rec.add_argument("--duration", type=float, default=0, help="Seconds to record (0 = until Ctrl+C).")
+
+    rep = sub.add_parser("replay", help="Replay a recording into a controller's on_message.")
+    rep.add_argument("file")
+    rep.add_argument("--target", default="mqtt.py", help="Controller script (mqtt.py, mqtt_Centos7.py, mqtt_localSQL.py).")
+    rep.add_argument("--speed", type=float, default=0, help="1 = real time, N = N times faster, 0 = max speed.")
+    rep.add_argument("--api-latency", type=float, default=0.0, help="Simulated remote API latency in seconds.")
+    rep.add_argument("--verbose", action="store_true", help="Show the controller's console output.")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.file, args.topic or ["greenhouse/#"], args.duration)
+    else:
+        target = args.target
+        if not os.path.exists(target):
+            target = os.path.join(os.path.dirname(os.path.abspath(__file__)), target)
+        replay(args.file, target, args.speed, args.api_latency, not args.verbose)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Rollup bucketing checks for mqtt_localSQL.py, run in a DST time zone against a throwaway database.
+
+    python3 -m unittest discover rp4/tests
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+os.environ["TZ"] = "America/New_York"
+time.tzset()
+
+RP4_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RP4_DIR)
+import mqtt_replay  # noqa: E402
+
+mqtt_replay.install_fake_gpio()
+controller = mqtt_replay.load_target(os.path.join(RP4_DIR, "mqtt_localSQL.py"))
+
+TOPIC = "greenhouse/sensor/air_th"
+STEP_MS = 10 * 60 * 1000  # One reading every 10 minutes
+
+
+def local_ms(*args) -> int:
+    return int(datetime(*args).timestamp()) * 1000
+
+
+class DstRollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        controller.DB_NAME = os.path.join(self.workdir.name, "greenhouse_data.db")
+        controller.series_ids.clear()
+        controller.known_partitions.clear()
+        controller.init_db()
+        self.series_id = controller.get_series_id(TOPIC, "temp")
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def store_day(self, year: int, month: int, day: int) -> tuple[int, int]:
+        """Writes 10-minute readings from local midnight to the next local midnight; returns (start, end) ms."""
+        start, end = local_ms(year, month, day), local_ms(year, month, day + 1)
+        controller.write_rows_now("readings", [(self.series_id, ts, 1.0) for ts in range(start, end, STEP_MS)])
+        return start, end
+
+    def buckets(self, resolution: str) -> list:
+        conn = sqlite3.connect(controller.DB_NAME)
+        try:
+            return conn.execute(
+                "SELECT bucket, count FROM rollups WHERE resolution = ? AND series_id = ? ORDER BY bucket",
+                (controller.ROLLUP_RESOLUTIONS[resolution], self.series_id)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def assert_one_day(self, start: int, end: int, hours: int):
+        self.assertEqual(self.buckets("day"), [(start, hours * 6)])
+        hour_buckets = self.buckets("hour")
+        self.assertEqual(len(hour_buckets), hours)
+        self.assertTrue(all(count == 6 for _, count in hour_buckets))
+        self.assertEqual(controller.bucket_floor(end - 1, 86400), start)
+        self.assertEqual(controller.bucket_end(start, 86400), end)
+
+    def test_spring_forward_day_is_one_23_hour_bucket(self):
+        start, end = self.store_day(2026, 3, 8)
+        self.assert_one_day(start, end, 23)
+
+    def test_fall_back_day_is_one_25_hour_bucket(self):
+        start, end = self.store_day(2026, 11, 1)
+        self.assert_one_day(start, end, 25)
+
+    def test_late_reading_does_not_clobber_next_day(self):
+        start, end = self.store_day(2026, 3, 8)
+        next_start, next_end = self.store_day(2026, 3, 9)
+        controller.write_rows_now("readings", [(self.series_id, end - 1000, 2.0)])  # Refreshes the last hour of the DST day
+        self.assertEqual(self.buckets("day"), [(start, 23 * 6 + 1), (next_start, 24 * 6)])
+
+
+if __name__ == "__main__":
+    unittest.main()